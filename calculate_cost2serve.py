@@ -1,21 +1,304 @@
 # %%
 import json
 import matplotlib.pyplot as plt
-from vrp_algorithms.Sweep import run_vehicle_routing_sweep
-from vrp_algorithms.savings import run_vehicle_routing_savings
+import numpy as np
+from vrp_algorithms import solvers
+from vrp_algorithms.Sweep import sweep_leave_one_out_distances
+from vrp_algorithms.savings import savings_leave_one_out_distances
+from vrp_algorithms.shapley import shapley_distances, SHAPLEY_TOLERANCE
+from utilities.pool_utils import map_in_chunks
 import time
 
+# routing_heuristic_index options
+SWEEP = 0
+SAVINGS = 1
+MULTI_START_SAVINGS = 2
+IMPROVED_SWEEP = 3
+IMPROVED_SAVINGS = 4
+LNS = 5
+PORTFOLIO = 6
 
-def calculate_distance_to_serve(customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index=0):
+# The registered solver (see vrp_algorithms.solvers) selected by each routing_heuristic_index
+ROUTING_HEURISTICS = {SWEEP: solvers.SWEEP, SAVINGS: solvers.SAVINGS, MULTI_START_SAVINGS: solvers.MULTI_START_SAVINGS,
+                      IMPROVED_SWEEP: solvers.IMPROVED_SWEEP, IMPROVED_SAVINGS: solvers.IMPROVED_SAVINGS,
+                      LNS: solvers.LNS}
+
+
+def run_vehicle_routing(customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index=SWEEP,
+                        time_limit=None, workers=None):
+    """Runs the routing heuristic selected by routing_heuristic_index (one of the ROUTING_HEURISTICS indices, the name
+    of a registered solver, or PORTFOLIO) and returns its JSON list of route dicts. time_limit (in seconds) bounds the
+    solvers that can trade time for quality, and is the deadline of the PORTFOLIO of solvers (see
+    solvers.run_portfolio). workers is the number of processes of the solvers using a process pool (1 runs them
+    serially)."""
+    if routing_heuristic_index == PORTFOLIO:
+        return solvers.run_portfolio(customer_data, vehicle_capacity_data, depot_data,
+                                     time_limit=time_limit or solvers.PORTFOLIO_TIME_LIMIT, workers=workers)
+    return solvers.solve(routing_heuristic_name(routing_heuristic_index), customer_data, vehicle_capacity_data,
+                         depot_data, time_limit, workers)
+
+
+def routing_heuristic_name(routing_heuristic_index):
+    """Name of the registered solver selected by routing_heuristic_index (an index or a name)"""
+    if isinstance(routing_heuristic_index, str):
+        return routing_heuristic_index
+    # as before the registry, any other index runs the savings heuristic
+    return ROUTING_HEURISTICS.get(routing_heuristic_index, solvers.SAVINGS)
+
+
+def route_distance_measure(routing_heuristic_index):
+    """(round_distances, return_to_depot) of the route distances reported by routing_heuristic_index (see
+    solvers.route_distance_measures). Whichever solver wins, run_portfolio measures its routes again with
+    solvers.route_dicts_distance: unrounded, including the return to the depot."""
+    if routing_heuristic_index == PORTFOLIO:
+        return False, True
+    return solvers.route_distance_measures[routing_heuristic_name(routing_heuristic_index)]
+
+
+def _leave_one_out_worker(customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index, time_limit,
+                          indices):
+    """Total distances of the routing heuristic without each of the customers at indices (run in a worker process,
+    where the solvers run serially)"""
+    return [sum(item["route_distance"] for item in
+                json.loads(run_vehicle_routing(customer_data[:i] + customer_data[i + 1:], vehicle_capacity_data,
+                                               depot_data, routing_heuristic_index, time_limit, workers=1)))
+            if len(customer_data) > 1 else 0
+            for i in indices]
+
+
+def removal_deltas(route_dicts, customer_data, depot_data, round_distances=False, return_to_depot=True,
+                   route_elimination_cost=0.0):
+    """Approximate marginal distance of every customer of a solution (route dicts as returned by run_vehicle_routing):
+    the distance saved by taking the customer c out of its route and linking its neighbours,
+    D[prev, c] + D[c, next] - D[prev, next], for all the customers in one vectorised pass. The distances are measured
+    as the solver measures them (see solvers.route_distance_measures). Customers alone in their route also save
+    route_elimination_cost (e.g. a fixed cost per vehicle). Returns a dict of the deltas by customer index (id - 1)."""
+    row = {-1: 0}
+    row.update((c['id'] - 1, k + 1) for k, c in enumerate(customer_data))
+    xy = np.array([(depot_data["x"], depot_data["y"])] + [(c["x"], c["y"]) for c in customer_data], dtype=float)
+
+    previous, customers, following, alone = [], [], [], []
+    for route in route_dicts:
+        indices = [row[index] for index in route["customer_indices"] if index != -1]
+        previous += [0] + indices[:-1]
+        customers += indices
+        following += indices[1:] + [0]
+        alone += [len(indices) == 1] * len(indices)
+    previous, customers, following = np.array(previous), np.array(customers, dtype=int), np.array(following)
+
+    def arc_lengths(a, b):
+        d = np.hypot(*(xy[a] - xy[b]).T)
+        if round_distances:
+            d = np.rint(d)
+        if not return_to_depot:
+            d[b == 0] = 0.0
+        return d
+
+    deltas = arc_lengths(previous, customers) + arc_lengths(customers, following) - arc_lengths(previous, following) \
+        + route_elimination_cost * np.array(alone, dtype=float)
+    return {customer_data[k - 1]['id'] - 1: delta for k, delta in zip(customers.tolist(), deltas.tolist())}
+
+
+# Number of customers CostToServeService adds and removes incrementally before it solves the routes again from scratch
+COST_TO_SERVE_RESOLVE_AFTER = 25
+
+
+class CostToServeService:
+    """Approximate distance to serve (see removal_deltas) kept up to date across calls, for AnyLogic calling
+    calculate_distance_to_serve every time an order arrives or is delivered during a simulated day. The service lives
+    in the Python process (see cost_to_serve_service) and keeps the routes of the last call and the distance to serve
+    of every customer, keyed by customer id.
+
+    On the next call, the customers that are gone (or whose location or demand changed) are taken out of their routes
+    and the new ones are inserted where it is cheapest, or in a route of their own. The distance to serve of a
+    customer only depends on its route, so only the routes that changed are computed again; the values of the other
+    customers are cache hits. The routes are solved from scratch on the first call, when the depot, vehicle capacity,
+    routing heuristic or time limit change, and once more than resolve_after customers were added or removed since
+    the last time."""
+
+    def __init__(self, resolve_after=COST_TO_SERVE_RESOLVE_AFTER):
+        self.resolve_after = resolve_after
+        self.reset()
+
+    def reset(self):
+        """Forgets the routes and values, and zeroes the counts"""
+        self.settings = None
+        self.customers = {}
+        self.routes = []
+        self.values = {}
+        self.changes = 0
+        self.hits = 0
+        self.recomputes = 0
+        self.resolves = 0
+
+    def statistics(self):
+        """Counts of the values served from the cache (hits), computed again (recomputes) and of the routes solved
+        from scratch (resolves)"""
+        return {"hits": self.hits, "recomputes": self.recomputes, "resolves": self.resolves,
+                "customers": len(self.values), "routes": len(self.routes)}
+
+    def arc_lengths(self, a, b, into_depot):
+        """Lengths of the arcs between the coordinates in a and b, measured as the routing heuristic does (into_depot
+        is True where b is the depot)"""
+        d = np.hypot(*(a - b).T)
+        if self.round_distances:
+            d = np.rint(d)
+        if not self.return_to_depot:
+            d[into_depot] = 0.0
+        return d
+
+    def insertion(self, customer_id):
+        """Cheapest feasible insertion of a customer into the routes: (cost, route, position), with route None if the
+        customer is best served by a route of its own"""
+        customer = self.customers[customer_id]
+        xy = np.array((customer["x"], customer["y"]), dtype=float)
+        new_route_cost = float(self.arc_lengths(self.depot_xy[None], xy[None], np.zeros(1, dtype=bool))[0] +
+                               self.arc_lengths(xy[None], self.depot_xy[None], np.ones(1, dtype=bool))[0])
+        best = (new_route_cost, None, None)
+        for r, route in enumerate(self.routes):
+            if sum(self.customers[i]["demand"] for i in route) + customer["demand"] > self.vehicle_capacity:
+                continue
+            nodes = np.array([self.depot_xy] + [(self.customers[i]["x"], self.customers[i]["y"]) for i in route] +
+                             [self.depot_xy], dtype=float)
+            into_depot = np.arange(1, len(nodes)) == len(nodes) - 1
+            delta = self.arc_lengths(nodes[:-1], xy[None], np.zeros(len(nodes) - 1, dtype=bool)) + \
+                self.arc_lengths(xy[None], nodes[1:], into_depot) - self.arc_lengths(nodes[:-1], nodes[1:], into_depot)
+            position = int(np.argmin(delta))
+            if delta[position] < best[0]:
+                best = (float(delta[position]), r, position)
+        return best
+
+    def recompute(self, route_numbers):
+        """Computes the values of the customers of the given routes again"""
+        route_dicts = [{"customer_indices": [-1] + [self.customers[i]["id"] - 1 for i in self.routes[r]] + [-1]}
+                       for r in route_numbers if self.routes[r]]
+        customers = [self.customers[i] for r in route_numbers for i in self.routes[r]]
+        if not customers:
+            return
+        deltas = removal_deltas(route_dicts, customers, self.depot, self.round_distances, self.return_to_depot,
+                                self.route_elimination_cost)
+        for c in customers:
+            self.values[c["id"]] = deltas[c["id"] - 1]
+        self.recomputes += len(customers)
+
+    def resolve(self, customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index, time_limit):
+        """Solves the routes from scratch and computes all the values"""
+        self.routes, self.values, self.changes = [], {}, 0
+        if customer_data:
+            ids = {c["id"] - 1: c["id"] for c in customer_data}
+            route_dicts = json.loads(run_vehicle_routing(customer_data, vehicle_capacity_data, depot_data,
+                                                         routing_heuristic_index, time_limit))
+            self.routes = [[ids[index] for index in route["customer_indices"] if index != -1]
+                           for route in route_dicts]
+            self.routes = [route for route in self.routes if route]
+        self.recompute(range(len(self.routes)))
+        self.resolves += 1
+
+    def distance_to_serve(self, customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index=SWEEP,
+                          time_limit=None, route_elimination_cost=0.0):
+        """Distance to serve of every customer (in customer_data order), updating the routes of the last call"""
+        settings = (depot_data["x"], depot_data["y"], vehicle_capacity_data, routing_heuristic_index, time_limit,
+                    route_elimination_cost)
+        customers = {c["id"]: c for c in customer_data}
+        removed = [i for i, c in self.customers.items()
+                   if i not in customers or (c["x"], c["y"], c["demand"]) !=
+                   (customers[i]["x"], customers[i]["y"], customers[i]["demand"])]
+        added = [i for i in customers if i not in self.customers] + [i for i in removed if i in customers]
+
+        self.customers = customers
+        self.depot, self.depot_xy = depot_data, np.array((depot_data["x"], depot_data["y"]), dtype=float)
+        self.vehicle_capacity = vehicle_capacity_data
+        self.route_elimination_cost = route_elimination_cost
+        self.round_distances, self.return_to_depot = route_distance_measure(routing_heuristic_index)
+
+        if settings != self.settings or self.changes + len(removed) + len(added) > self.resolve_after:
+            self.settings = settings
+            self.resolve(customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index, time_limit)
+        elif removed or added:
+            changed_routes = set()
+            removed = set(removed)
+            for r, route in enumerate(self.routes):
+                if removed.intersection(route):
+                    self.routes[r] = [i for i in route if i not in removed]
+                    changed_routes.add(r)
+            for i in removed:
+                self.values.pop(i, None)
+            for i in added:
+                _, r, position = self.insertion(i)
+                if r is None:
+                    self.routes.append([i])
+                    r = len(self.routes) - 1
+                else:
+                    self.routes[r].insert(position, i)
+                changed_routes.add(r)
+            self.hits += sum(len(route) for r, route in enumerate(self.routes) if r not in changed_routes)
+            self.recompute(sorted(changed_routes))
+            self.routes = [route for route in self.routes if route]
+            self.changes += len(removed) + len(added)
+        else:
+            self.hits += len(customers)
+
+        return [self.values[c["id"]] for c in customer_data]
+
+
+# The cost to serve service of this process, kept between the AnyLogic calls
+cost_to_serve_service = CostToServeService()
+
+
+def calculate_distance_to_serve(customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index=SWEEP,
+                                time_limit=None, workers=None, approximate=False, route_elimination_cost=0.0,
+                                incremental=False):
+    """Distance to serve of every customer: the total distance of the routes with all the customers minus the total
+    distance without that customer. If workers is given, the leave-one-out runs are spread in chunks over a persistent
+    pool of that many worker processes (the sweep and savings ones read the instance from shared memory). Returns the
+    JSON list of {"index", "distance_to_serve"} dicts, in customer_data order.
+
+    If approximate is set, the routes are computed only once and the distance to serve of every customer is its
+    removal delta in those routes (see removal_deltas) instead. If incremental is set, these approximate values are
+    kept up to date between the calls by cost_to_serve_service, which only computes again the routes of the customers
+    added or removed since the last call."""
     tic = time.perf_counter()
 
-    if routing_heuristic_index == 0:
-        total_vrp_result = json.loads(run_vehicle_routing_sweep(customer_data, vehicle_capacity_data, depot_data))
+    name = routing_heuristic_name(routing_heuristic_index) if routing_heuristic_index != PORTFOLIO else None
+    if incremental:
+        total_vrp_distance = 0.0
+        leave_one_out_distances = [-value for value in cost_to_serve_service.distance_to_serve(
+            customer_data, vehicle_capacity_data, depot_data, routing_heuristic_index, time_limit,
+            route_elimination_cost)]
+    elif approximate:
+        total_vrp_result = json.loads(run_vehicle_routing(customer_data, vehicle_capacity_data, depot_data,
+                                                          routing_heuristic_index, time_limit))
+        round_distances, return_to_depot = route_distance_measure(routing_heuristic_index)
+        deltas = removal_deltas(total_vrp_result, customer_data, depot_data, round_distances, return_to_depot,
+                                route_elimination_cost)
+        total_vrp_distance = 0.0
+        # the distance to serve is the delta itself
+        leave_one_out_distances = [-deltas[c['id'] - 1] for c in customer_data]
+    elif name == solvers.SWEEP and time_limit is None:
+        # incremental leave-one-out: without a customer, only the clusters that change are routed again
+        total_vrp_distance, leave_one_out_distances = sweep_leave_one_out_distances(customer_data,
+                                                                                    vehicle_capacity_data, depot_data,
+                                                                                    workers=workers)
+        total_vrp_distance = round(total_vrp_distance, 4)
+    elif name == solvers.SAVINGS:
+        # the distance matrix and sorted savings are built once, the customer is masked out of the savings
+        total_vrp_distance, leave_one_out_distances = savings_leave_one_out_distances(customer_data,
+                                                                                      vehicle_capacity_data,
+                                                                                      depot_data, workers=workers)
+        total_vrp_distance = round(total_vrp_distance, 4)
     else:
-        total_vrp_result = json.loads(run_vehicle_routing_savings(customer_data, vehicle_capacity_data, depot_data))
+        leave_one_out_distances = None
+        total_vrp_result = json.loads(run_vehicle_routing(customer_data, vehicle_capacity_data, depot_data,
+                                                          routing_heuristic_index, time_limit))
 
-    # print(total_vrp_result)
-    total_vrp_distance = round(sum(item["route_distance"] for item in total_vrp_result), 4)
+        # print(total_vrp_result)
+        total_vrp_distance = round(sum(item["route_distance"] for item in total_vrp_result), 4)
+
+        # the portfolio runs its solvers in the process pool itself
+        if workers is not None and name is not None:
+            leave_one_out_distances = map_in_chunks(_leave_one_out_worker, list(range(len(customer_data))), workers,
+                                                    customer_data, vehicle_capacity_data, depot_data,
+                                                    routing_heuristic_index, time_limit)
     # print("Total cvrp distance: ", total_vrp_distance)
 
     distance_to_serve_list = []
@@ -25,6 +308,13 @@ def calculate_distance_to_serve(customer_data, vehicle_capacity_data, depot_data
 
         temp_dict = {}
 
+        if leave_one_out_distances is not None:
+            current_distance_to_serve = total_vrp_distance - leave_one_out_distances[i]
+            distance_to_serve_list.append(current_distance_to_serve)
+            distance_to_serve_dict.append({"index": customer_data[i]['id'] - 1,
+                                           "distance_to_serve": round(current_distance_to_serve, 4)})
+            continue
+
         c = customer_data.pop(i)  # we are calculating the distance_to_serve of c. remove him from cvrp customers
 
         temp_dict = {"index": c['id'] - 1}
@@ -32,12 +322,8 @@ def calculate_distance_to_serve(customer_data, vehicle_capacity_data, depot_data
         # print(customer_data)
 
         if len(customer_data) > 0:
-            if routing_heuristic_index == 0:
-                vrp_results = run_vehicle_routing_sweep(customer_data, vehicle_capacity_data,
-                                                        depot_data)  # run vrp on all but c
-            else:
-                vrp_results = run_vehicle_routing_savings(customer_data, vehicle_capacity_data,
-                                                          depot_data)
+            vrp_results = run_vehicle_routing(customer_data, vehicle_capacity_data, depot_data,
+                                              routing_heuristic_index, time_limit)  # run vrp on all but c
 
             vrp_results_parsed = json.loads(vrp_results)  # parse results
             current_vrp_distance = sum(
@@ -51,11 +337,11 @@ def calculate_distance_to_serve(customer_data, vehicle_capacity_data, depot_data
         distance_to_serve_list.append(current_distance_to_serve)  # add to distance_to_serve list
         temp_dict["distance_to_serve"] = round(current_distance_to_serve, 4)  #
         distance_to_serve_dict.append(temp_dict)
-        distance_to_serve_dict_json = json.dumps(distance_to_serve_dict)  # json.dumps is used to make the dictionary
 
         # print( f"Current cvrp distance: {current_vrp_distance}. Customer {c['id']-1} has a distance to serve of {
         # current_distance_to_serve}.")
 
+    distance_to_serve_dict_json = json.dumps(distance_to_serve_dict)  # json.dumps is used to make the dictionary
     print(distance_to_serve_dict_json)
     toc = time.perf_counter()
     print(f"Calculated distance to serve in {toc - tic:0.4f} seconds")
@@ -63,6 +349,30 @@ def calculate_distance_to_serve(customer_data, vehicle_capacity_data, depot_data
     return distance_to_serve_dict_json
 
 
+def calculate_shapley_distance_to_serve(customer_data, vehicle_capacity_data, depot_data,
+                                        tolerance=SHAPLEY_TOLERANCE, workers=None, seed=None):
+    """Shapley allocation of the distance: the mean marginal distance of every customer over random orders in which
+    the customers join routes built by cheapest insertion (see vrp_algorithms.shapley). Unlike the leave-one-out
+    distance to serve, the values add up to the (expected) total distance, so customers in dense clusters are not all
+    charged as if they were the last one served. The permutations are sampled until the confidence interval of every
+    customer is at most tolerance wide on either side, in batches over a persistent pool of `workers` processes if
+    given. Returns the JSON list of {"index", "distance_to_serve", "half_width"} dicts, in customer_data order."""
+    tic = time.perf_counter()
+
+    shapley_values, half_widths, permutations = shapley_distances(customer_data, vehicle_capacity_data, depot_data,
+                                                                  tolerance, workers, seed)
+    distance_to_serve_dict = [{"index": c['id'] - 1, "distance_to_serve": round(float(value), 4),
+                               "half_width": round(float(half_width), 4)}
+                              for c, value, half_width in zip(customer_data, shapley_values, half_widths)]
+
+    distance_to_serve_dict_json = json.dumps(distance_to_serve_dict)
+    print(distance_to_serve_dict_json)
+    toc = time.perf_counter()
+    print(f"Calculated Shapley distance to serve ({permutations} permutations) in {toc - tic:0.4f} seconds")
+
+    return distance_to_serve_dict_json
+
+
 # %%
 def main():
     """main()"""
@@ -0,0 +1,149 @@
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+import numpy as np
+
+_process_pools = {}
+
+# Number of chunks per worker process split_in_chunks makes. More chunks balance the load better, fewer chunks pay less
+# for the calls to the workers.
+CHUNKS_PER_WORKER = 4
+
+
+def get_process_pool(workers=None):
+    """utilities.pool_utils.get_process_pool(workers=None)
+
+    Returns a persistent ProcessPoolExecutor with the given number of worker processes (default: one per CPU). Starting
+    the worker processes costs far more than most of the jobs sent to them, so the pools are kept alive between calls
+    (e.g. across AnyLogic calls) and only shut down when the interpreter exits.
+
+    In the worker processes themselves (e.g. a multi-start savings run in a leave-one-out worker), a SerialExecutor is
+    returned instead: the nested jobs run one after the other in the worker."""
+    if in_worker_process():
+        return SerialExecutor()
+    workers = workers or os.cpu_count() or 1
+    pool = _process_pools.get(workers)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        _process_pools[workers] = pool
+    return pool
+
+
+def shutdown_process_pools():
+    """utilities.pool_utils.shutdown_process_pools()"""
+    while _process_pools:
+        _, pool = _process_pools.popitem()
+        pool.shutdown(wait=False)
+
+
+def discard_process_pool(pool):
+    """utilities.pool_utils.discard_process_pool(pool)
+
+    Stops the worker processes of a pool returned by get_process_pool, with the jobs still running in them (e.g. the
+    solvers run_portfolio gave up on, which cannot be cancelled once started). The next get_process_pool call with the
+    same number of workers starts a new pool, so its jobs do not queue behind the abandoned ones."""
+    for workers, persistent_pool in list(_process_pools.items()):
+        if persistent_pool is pool:
+            del _process_pools[workers]
+    if not isinstance(pool, ProcessPoolExecutor):
+        return
+    pool.shutdown(wait=False)
+    terminate_workers = getattr(pool, "terminate_workers", None)
+    if terminate_workers is not None:
+        terminate_workers()
+    else:
+        # before Python 3.14, the executor has no public way to stop its worker processes
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+
+
+atexit.register(shutdown_process_pools)
+# forked worker processes must not use the pools of their parent, which only the parent can send jobs to
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_process_pools.clear)
+
+
+def in_worker_process():
+    """utilities.pool_utils.in_worker_process()
+
+    True in a worker process of the pools (or any other child process started by multiprocessing)"""
+    return multiprocessing.current_process().name != "MainProcess"
+
+
+class SerialExecutor(Executor):
+    """Executor running every job in the calling process as soon as it is submitted, for the nested pools of the
+    worker processes"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def share_array(array):
+    """utilities.pool_utils.share_array(array)
+
+    Copies array into a new shared memory block. Returns the SharedMemory, which the caller has to close and unlink
+    once the workers are done with it, and a picklable descriptor to pass to attach_array in the workers. Structured
+    (record) arrays can be shared as well."""
+    # multiprocessing.shared_memory is only available from Python 3.8 on, the heuristics do not need it otherwise
+    from multiprocessing import shared_memory
+
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype)
+
+
+def attach_array(descriptor):
+    """utilities.pool_utils.attach_array(descriptor)
+
+    Attaches to an array shared with share_array. Returns the SharedMemory and the array backed by it. Every reference
+    to the array has to be dropped before the SharedMemory is closed."""
+    name, shape, dtype = descriptor
+    shm = _attach_shared_memory(name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _attach_shared_memory(name):
+    """Attaches to the shared memory block name without registering it with the resource tracker: the process that
+    created the block unlinks it, a worker registering it as well makes the tracker report it as leaked (and unlink it
+    a second time) at shutdown"""
+    from multiprocessing import shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13, attaching always registers the block
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None if rtype == "shared_memory" else register(name, rtype)
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def split_in_chunks(items, workers, chunks_per_worker=CHUNKS_PER_WORKER):
+    """utilities.pool_utils.split_in_chunks(items, workers, chunks_per_worker=CHUNKS_PER_WORKER)
+
+    Splits the list items into consecutive chunks, about chunks_per_worker per worker process. The results of the
+    chunks, concatenated in order, are in the order of items."""
+    chunk_size = max(1, -(-len(items) // (workers * chunks_per_worker)))
+    return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+
+def map_in_chunks(fn, items, workers, *args):
+    """utilities.pool_utils.map_in_chunks(fn, items, workers, *args)
+
+    Calls fn(*args, chunk) on the chunks of the list items (see split_in_chunks) in the persistent pool of `workers`
+    processes. fn returns a list with one result per item of its chunk; the results are returned in the order of
+    items."""
+    pool = get_process_pool(workers)
+    futures = [pool.submit(fn, *args, chunk) for chunk in split_in_chunks(items, workers)]
+    return [result for future in futures for result in future.result()]
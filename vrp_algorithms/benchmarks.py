@@ -0,0 +1,132 @@
+import contextlib
+import io
+import json
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import calculate_cost2serve
+from vrp_algorithms.savings import create_customer_list, create_distance_matrix, create_coordinate_distances, \
+    parallel_savings_init, clarke_wright_savings_array, neighbour_savings_array
+from vrp_algorithms.Sweep import run_vehicle_routing_sweep, GREEDY, PRINS_SPLIT
+from utilities.utils import objf
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
+
+
+def load_test_instances(data_dir=TEST_DATA_DIR):
+    """Returns a dict of the Solomon instances in data_dir, keyed by instance name"""
+    instances = {}
+    for file_name in sorted(os.listdir(data_dir)):
+        if not file_name.endswith(".json") or file_name == "output.json":
+            continue
+        with open(os.path.join(data_dir, file_name)) as inputFile:
+            instances[file_name[:-len(".json")]] = json.load(inputFile)
+    return instances
+
+
+def benchmark_neighbour_savings(neighbourhood_sizes=(5, 10, 20, 40), data_dir=TEST_DATA_DIR):
+    """Compares the total distance and run time of the sparse (granular) savings for each neighbourhood size k with
+    the full savings list on the Solomon instances. Returns a DataFrame with one row per instance and k (k = 0 is the
+    full savings list)."""
+    results = []
+    for instance_name, data in load_test_instances(data_dir).items():
+        Customers = create_customer_list(data["customers"], data["depot"])
+        demands = [round(i.demand) for i in Customers]
+        capacity = round(data["vehicle_capacity"])
+        D = create_distance_matrix(Customers)
+
+        tic = time.perf_counter()
+        sol = parallel_savings_init(D, demands, capacity, savings_callback=clarke_wright_savings_array)
+        toc = time.perf_counter()
+        full_distance = objf(sol, D)
+        results.append({"instance": instance_name, "k": 0, "distance": full_distance, "gap_%": 0.0,
+                        "seconds": toc - tic})
+
+        for k in neighbourhood_sizes:
+            coordinate_distances = create_coordinate_distances(Customers)
+            tic = time.perf_counter()
+            sol = parallel_savings_init(coordinate_distances, demands, capacity,
+                                        savings_callback=partial(neighbour_savings_array, k=k))
+            toc = time.perf_counter()
+            distance = objf(sol, D)
+            results.append({"instance": instance_name, "k": k, "distance": distance,
+                            "gap_%": 100 * (distance - full_distance) / full_distance, "seconds": toc - tic})
+
+    return pd.DataFrame(results)
+
+
+def benchmark_sweep_split(data_dir=TEST_DATA_DIR):
+    """Compares the greedy sweep cut with the optimal (Prins) split of the same angular order on the Solomon
+    instances: total distance after the TSP stage, number of routes and run time (without the TSP cache, so every
+    run solves all its cluster TSPs). Returns a DataFrame with one row per instance."""
+    results = []
+    for instance_name, data in load_test_instances(data_dir).items():
+        row = {"instance": instance_name}
+        for clustering in (GREEDY, PRINS_SPLIT):
+            tic = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                routes = json.loads(run_vehicle_routing_sweep(data["customers"], data["vehicle_capacity"],
+                                                              data["depot"], clustering=clustering, cache=None))
+            toc = time.perf_counter()
+            row[clustering + "_distance"] = sum(route["route_distance"] for route in routes)
+            row[clustering + "_routes"] = len(routes)
+            row[clustering + "_seconds"] = toc - tic
+        row["saving_%"] = 100 * (row[GREEDY + "_distance"] - row[PRINS_SPLIT + "_distance"]) / row[GREEDY + "_distance"]
+        results.append(row)
+
+    return pd.DataFrame(results)
+
+
+def benchmark_approximate_distance_to_serve(routing_heuristic_indices=(calculate_cost2serve.SWEEP,
+                                                                     calculate_cost2serve.SAVINGS),
+                                            data_dir=TEST_DATA_DIR):
+    """Error of the approximate distance to serve (the removal deltas in the routes with all the customers) against
+    the exact leave-one-out distance to serve on the Solomon instances: mean and largest absolute error, RMSE, rank
+    (Spearman) correlation of the customers and the run time of both. Returns a DataFrame with one row per instance
+    and routing heuristic."""
+    results = []
+    for instance_name, data in load_test_instances(data_dir).items():
+        for routing_heuristic_index in routing_heuristic_indices:
+            row = {"instance": instance_name,
+                   "heuristic": calculate_cost2serve.routing_heuristic_name(routing_heuristic_index)}
+            distances_to_serve = {}
+            for approximate in (False, True):
+                tic = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = json.loads(calculate_cost2serve.calculate_distance_to_serve(
+                        data["customers"], data["vehicle_capacity"], data["depot"], routing_heuristic_index,
+                        approximate=approximate))
+                toc = time.perf_counter()
+                distances_to_serve[approximate] = pd.Series([item["distance_to_serve"] for item in result])
+                row[("approximate" if approximate else "exact") + "_seconds"] = toc - tic
+            error = distances_to_serve[True] - distances_to_serve[False]
+            row["mean_abs_error"] = error.abs().mean()
+            row["max_abs_error"] = error.abs().max()
+            row["rmse"] = float(np.sqrt((error ** 2).mean()))
+            row["rank_correlation"] = distances_to_serve[True].corr(distances_to_serve[False], method="spearman")
+            results.append(row)
+
+    return pd.DataFrame(results)
+
+
+def main():
+    """main()"""
+    df_results = benchmark_neighbour_savings()
+    print(df_results.to_string(index=False))
+    print(df_results.groupby("k")[["gap_%", "seconds"]].mean())
+
+    df_results = benchmark_sweep_split()
+    print(df_results.to_string(index=False))
+    print(df_results.mean(numeric_only=True))
+
+    df_results = benchmark_approximate_distance_to_serve()
+    print(df_results.to_string(index=False))
+    print(df_results.groupby("heuristic").mean(numeric_only=True))
+
+
+if __name__ == '__main__':
+    main()
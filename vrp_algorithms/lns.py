@@ -0,0 +1,254 @@
+import json
+import time
+
+import numpy as np
+
+from utilities.utils import routes2sol
+from vrp_algorithms.savings import create_customer_list, create_distance_matrix, create_coordinate_distances, \
+    parallel_savings_init, neighbour_savings_array, route_index_to_id, get_route_distance
+
+# Default wall-clock time limit of run_vehicle_routing_lns, in seconds
+LNS_TIME_LIMIT = 10.0
+# Number of customers removed by a ruin: uniform between the minimum and the smaller of the maximum and
+# RUIN_MAX_FRACTION of the customers
+RUIN_MIN_CUSTOMERS = 5
+RUIN_MAX_CUSTOMERS = 40
+RUIN_MAX_FRACTION = 0.3
+# Longest string of consecutive customers removed from a route by a string ruin
+RUIN_MAX_STRING_LENGTH = 10
+# A recreated solution is accepted if it is at most this fraction longer than the current one. The threshold decreases
+# linearly to 0 at the deadline.
+ACCEPTANCE_THRESHOLD = 0.02
+# Recreated solutions have to be shorter than the best one by more than this to become the best one
+LNS_EPS = 1e-6
+# From this many customers on, run_vehicle_routing_lns starts from the sparse (granular) savings solution, which takes
+# a fraction of the time of the full savings list on large instances
+LNS_GRANULAR_INITIAL_MIN_CUSTOMERS = 500
+
+RANDOM_RUIN = "random"
+RADIAL_RUIN = "radial"
+STRING_RUIN = "string"
+RUIN_OPERATORS = (RANDOM_RUIN, RADIAL_RUIN, STRING_RUIN)
+
+
+class RuinAndRecreate:
+    """Large neighbourhood search for the CVRP. Every iteration removes some customers from the current solution (ruin:
+    random customers, the customers nearest to a random one, or strings of consecutive customers from the routes near
+    a random one) and inserts them back with regret-2 insertion (recreate). The insertion costs of all the removed
+    customers into all the routes are kept in a cache, and only the column of the route that changed is recomputed
+    after each insertion. Recreated solutions are accepted with a threshold that decreases to 0 at the deadline.
+
+    Node 0 is the depot, routes is a list of routes (with or without the depot visits). The search is anytime: the
+    best solution found so far is kept in best_routes and best_cost. If return_to_depot is False, arcs into the depot
+    cost nothing (as in the distances reported by run_vehicle_routing_savings)."""
+
+    def __init__(self, distance_matrix_input, demand_list, vehicle_capacity, routes, seed=None,
+                 return_to_depot=True):
+        self.C = np.array(distance_matrix_input, dtype=float)
+        if not return_to_depot:
+            self.C[:, 0] = 0.0
+        self.demands = np.asarray(demand_list, dtype=float)
+        self.vehicle_capacity = vehicle_capacity
+        self.rng = np.random.default_rng(seed)
+        self.customers = np.arange(1, len(self.C))
+
+        self.routes = [[node for node in route if node] for route in routes]
+        self.routes = [route for route in self.routes if route]
+        self.cost = self.total_cost(self.routes)
+        self.best_routes = [route[:] for route in self.routes]
+        self.best_cost = self.cost
+        self.iterations = 0
+        self.ruin_statistics = {ruin: {"used": 0, "accepted": 0, "best": 0} for ruin in RUIN_OPERATORS}
+
+    def route_cost(self, route):
+        nodes = np.concatenate(([0], route, [0])).astype(np.int64)
+        return float(self.C[nodes[:-1], nodes[1:]].sum())
+
+    def total_cost(self, routes):
+        return sum(self.route_cost(route) for route in routes)
+
+    def nearest(self, customer):
+        """Customers in order of distance from customer (the customer itself first)"""
+        return np.argsort(self.C[customer, 1:], kind='stable') + 1
+
+    def ruin_size(self):
+        n = len(self.customers)
+        high = max(1, min(RUIN_MAX_CUSTOMERS, int(RUIN_MAX_FRACTION * n)))
+        return int(self.rng.integers(min(RUIN_MIN_CUSTOMERS, high), high + 1))
+
+    def ruin(self, operator, size):
+        """Returns the set of customers removed by the ruin operator"""
+        if operator == RANDOM_RUIN:
+            return set(self.rng.choice(self.customers, size, replace=False).tolist())
+        seed_customer = int(self.rng.choice(self.customers))
+        if operator == RADIAL_RUIN:
+            return set(self.nearest(seed_customer)[:size].tolist())
+
+        route_of = {node: r for r, route in enumerate(self.routes) for node in route}
+        removed = set()
+        ruined_routes = set()
+        for customer in self.nearest(seed_customer).tolist():
+            if len(removed) >= size:
+                break
+            r = route_of[customer]
+            if r in ruined_routes:
+                continue
+            ruined_routes.add(r)
+            route = self.routes[r]
+            length = int(self.rng.integers(1, min(RUIN_MAX_STRING_LENGTH, len(route), size - len(removed)) + 1))
+            position = route.index(customer)
+            start = int(self.rng.integers(max(0, position - length + 1), min(position, len(route) - length) + 1))
+            removed.update(route[start:start + length])
+        return removed
+
+    def recreate(self, routes, removed, deadline=None):
+        """Regret-2 insertion of the removed customers into routes (which is modified). Returns False if the deadline
+        passed before all the customers were inserted."""
+        C = self.C
+        unassigned = np.array(sorted(removed), dtype=np.int64)
+        self.rng.shuffle(unassigned)
+        loads = [float(self.demands[route].sum()) for route in routes]
+        insertion_costs = np.empty((len(unassigned), len(routes)))
+        insertion_positions = np.empty((len(unassigned), len(routes)), dtype=np.int64)
+
+        def update_column(r):
+            nodes = np.concatenate(([0], routes[r], [0])).astype(np.int64)
+            delta = C[nodes[:-1]][:, unassigned].T + C[unassigned][:, nodes[1:]] - C[nodes[:-1], nodes[1:]]
+            positions = np.argmin(delta, axis=1)
+            costs = delta[np.arange(len(unassigned)), positions]
+            insertion_costs[:, r] = np.where(loads[r] + self.demands[unassigned] <= self.vehicle_capacity, costs,
+                                             np.inf)
+            insertion_positions[:, r] = positions
+
+        for r in range(len(routes)):
+            update_column(r)
+
+        while len(unassigned):
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            # opening a new route is always an option
+            new_route_costs = C[0, unassigned] + C[unassigned, 0]
+            costs = np.column_stack((insertion_costs, new_route_costs))
+            two_best = np.partition(costs, 1, axis=1)[:, :2] if costs.shape[1] > 1 else \
+                np.column_stack((costs[:, 0], np.full(len(unassigned), np.inf)))
+            regret = np.where(np.isinf(two_best[:, 1]), np.inf, two_best[:, 1] - two_best[:, 0])
+            # the largest regret, ties broken by the cheapest insertion
+            k = int(np.lexsort((two_best[:, 0], -regret))[0])
+            customer = int(unassigned[k])
+            r = int(np.argmin(costs[k]))
+
+            if r == len(routes):
+                routes.append([customer])
+                loads.append(float(self.demands[customer]))
+                insertion_costs = np.column_stack((insertion_costs, np.empty(len(unassigned))))
+                insertion_positions = np.column_stack((insertion_positions,
+                                                       np.empty(len(unassigned), dtype=np.int64)))
+            else:
+                routes[r].insert(int(insertion_positions[k, r]), customer)
+                loads[r] += float(self.demands[customer])
+
+            unassigned = np.delete(unassigned, k)
+            insertion_costs = np.delete(insertion_costs, k, axis=0)
+            insertion_positions = np.delete(insertion_positions, k, axis=0)
+            if len(unassigned):
+                update_column(r)
+        return True
+
+    def iterate(self, threshold=0.0, deadline=None):
+        """One ruin and recreate iteration. Returns False if the deadline passed during the iteration."""
+        operator = RUIN_OPERATORS[int(self.rng.integers(len(RUIN_OPERATORS)))]
+        removed = self.ruin(operator, self.ruin_size())
+        routes = [[node for node in route if node not in removed] for route in self.routes]
+        routes = [route for route in routes if route]
+        if not self.recreate(routes, removed, deadline):
+            return False
+
+        self.iterations += 1
+        statistics = self.ruin_statistics[operator]
+        statistics["used"] += 1
+        cost = self.total_cost(routes)
+        if cost <= self.cost * (1.0 + threshold):
+            self.routes, self.cost = routes, cost
+            statistics["accepted"] += 1
+            if cost < self.best_cost - LNS_EPS:
+                self.best_routes, self.best_cost = [route[:] for route in routes], cost
+                statistics["best"] += 1
+        return True
+
+    def run(self, time_limit=LNS_TIME_LIMIT, max_iterations=None):
+        """Runs ruin and recreate iterations until time_limit seconds (wall-clock) have passed, or after
+        max_iterations iterations. An iteration still running at the deadline is abandoned. Returns the best routes
+        [0, ..., 0]."""
+        start = time.perf_counter()
+        deadline = start + time_limit
+        if len(self.customers) > 1 and time_limit > 0:
+            while max_iterations is None or self.iterations < max_iterations:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                threshold = ACCEPTANCE_THRESHOLD * (deadline - now) / time_limit
+                if not self.iterate(threshold, deadline):
+                    break
+        return self.solution()
+
+    def solution(self):
+        """The best routes found so far, as [0, ..., 0]"""
+        return [[0] + route + [0] for route in self.best_routes]
+
+
+def ruin_and_recreate(distance_matrix_input, demand_list, vehicle_capacity, time_limit=LNS_TIME_LIMIT, seed=None,
+                      return_to_depot=True, max_iterations=None, initial_sol=None, start=None):
+    """Large neighbourhood search (see RuinAndRecreate) starting from initial_sol (by default the parallel_savings_init
+    solution). Returns the best solution found within time_limit seconds from start (time.perf_counter(), by default
+    the call), in the giant tour format of parallel_savings_init. Building the initial solution counts towards the time
+    limit, but the initial solution is returned even if it took longer."""
+    start = time.perf_counter() if start is None else start
+    if initial_sol is None:
+        initial_sol = parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity)
+    # split the giant tour at the depot visits
+    initial_routes = [[]]
+    for node in initial_sol:
+        if node:
+            initial_routes[-1].append(node)
+        elif initial_routes[-1]:
+            initial_routes.append([])
+    search = RuinAndRecreate(distance_matrix_input, demand_list, vehicle_capacity, initial_routes, seed,
+                             return_to_depot)
+    return routes2sol(search.run(time_limit - (time.perf_counter() - start), max_iterations))
+
+
+def run_vehicle_routing_lns(customerData, vehicleCapacityData, depotData, time_limit=LNS_TIME_LIMIT, seed=None,
+                            return_to_depot=True):
+    """Runs ruin_and_recreate on the AnyLogic data, for time_limit seconds from the call. The search minimises the
+    length of the closed tours, or of the routes without the return to the depot if return_to_depot is False. The
+    route dicts are returned in the same format as by run_vehicle_routing_savings, with the distances measured the same
+    way (without the return to the depot)."""
+    start = time.perf_counter()
+    Customers = create_customer_list(customerData, depotData)
+    distance_matrix_input = create_distance_matrix(Customers)
+    demands = [round(i.demand) for i in Customers]
+
+    initial_sol = None
+    if len(Customers) - 1 >= LNS_GRANULAR_INITIAL_MIN_CUSTOMERS:
+        initial_sol = parallel_savings_init(create_coordinate_distances(Customers), demands,
+                                            round(vehicleCapacityData), savings_callback=neighbour_savings_array)
+    sol = ruin_and_recreate(distance_matrix_input, demands, round(vehicleCapacityData), time_limit, seed,
+                            return_to_depot, initial_sol=initial_sol, start=start)
+
+    list_of_route_dicts = []
+    if sol:
+        route = [0]
+        for node in sol[1:]:
+            route.append(node)
+            if node == 0:
+                list_of_route_dicts.append({'route_number': len(list_of_route_dicts),
+                                            'customer_indices': route_index_to_id(route, Customers),
+                                            'route_distance': get_route_distance(route, distance_matrix_input)})
+                route = [0]
+    else:
+        list_of_route_dicts.append({'route_number': 0, 'customer_indices': [-1, -1], 'route_distance': 0.0})
+
+    list_of_route_dicts_json = json.dumps(list_of_route_dicts)
+    print("Final routes: ", list_of_route_dicts_json)
+
+    return list_of_route_dicts_json
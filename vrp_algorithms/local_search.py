@@ -0,0 +1,292 @@
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Moves have to improve the route length by more than this to be applied
+IMPROVEMENT_EPS = 1e-9
+# Lengths of the segments moved by Or-opt
+OR_OPT_SEGMENT_LENGTHS = (1, 2, 3)
+
+
+def route_submatrix(route, D):
+    """Distance matrix between the nodes of route (a list of indices of D), in route order. D can be a distance matrix
+    or a CoordinateDistances instance."""
+    if hasattr(D, "pairs"):
+        nodes = np.asarray(route)
+        return D.pairs(nodes[:, np.newaxis], nodes[np.newaxis, :])
+    return np.asarray(D, dtype=float)[np.ix_(route, route)]
+
+
+def route_length(route, D):
+    """Length of route (a list of indices of D, including the depot visits)"""
+    return sum(D[route[k], route[k + 1]] for k in range(len(route) - 1))
+
+
+def best_two_opt_move(order, L):
+    """Evaluates all 2-opt moves of the route `order` (positions in the route distance matrix L) at once: removing the
+    edges (i, i + 1) and (j, j + 1) and reversing the segment in between. Returns (delta, i, j) of the best one."""
+    n = len(order)
+    if n < 4:
+        return 0.0, 0, 0
+    i, j = np.triu_indices(n - 1, k=2)
+    a, b, c, d = order[i], order[i + 1], order[j], order[j + 1]
+    delta = L[a, c] + L[b, d] - L[a, b] - L[c, d]
+    best = int(np.argmin(delta))
+    return float(delta[best]), int(i[best]), int(j[best])
+
+
+def best_or_opt_move(order, L, segment_lengths=OR_OPT_SEGMENT_LENGTHS):
+    """Evaluates all Or-opt moves of the route `order` (positions in the route distance matrix L) at once: moving the
+    segment of s customers starting at position p between positions q and q + 1, as is or reversed. Returns
+    (delta, p, s, q, reverse) of the best one."""
+    n = len(order)
+    best_move = (0.0, 0, 0, 0, False)
+    for s in segment_lengths:
+        if n - 1 - s < 1:
+            break
+        p, q = np.meshgrid(np.arange(1, n - s), np.arange(0, n - 1), indexing='ij')
+        valid = (q <= p - 2) | (q >= p + s)
+        if not valid.any():
+            continue
+        first, last = order[p], order[p + s - 1]
+        previous, following = order[p - 1], order[p + s]
+        u, v = order[q], order[q + 1]
+        removal_gain = L[previous, first] + L[last, following] - L[previous, following]
+        forward = np.where(valid, L[u, first] + L[last, v] - L[u, v] - removal_gain, np.inf)
+        backward = np.where(valid, L[u, last] + L[first, v] - L[u, v] - removal_gain, np.inf)
+        for reverse, delta in ((False, forward), (True, backward)):
+            best = np.unravel_index(int(np.argmin(delta)), delta.shape)
+            if delta[best] < best_move[0]:
+                best_move = (float(delta[best]), int(p[best]), s, int(q[best]), reverse)
+    return best_move
+
+
+def apply_or_opt_move(order, p, s, q, reverse):
+    segment = order[p:p + s][::-1] if reverse else order[p:p + s]
+    if q < p:
+        return np.concatenate((order[:q + 1], segment, order[q + 1:p], order[p + s:]))
+    return np.concatenate((order[:p], order[p + s:q + 1], segment, order[q + 1:]))
+
+
+def improve_route(route, D, max_iterations=None, return_to_depot=True):
+    """Intra-route local search: repeatedly applies the best improving 2-opt or Or-opt move, each evaluated for the
+    whole route at once with NumPy fancy indexing on the route distance matrix, until no move improves the route (or
+    after max_iterations moves). route is a list of indices of D that starts and ends at the depot. If return_to_depot
+    is False, the arc back to the depot is not counted (as in the distances reported by run_vehicle_routing_savings).
+    Returns the improved route."""
+    if len(route) < 4:
+        return list(route)
+    L = route_submatrix(route, D)
+    if not return_to_depot:
+        # the last position of the route is the return to the depot
+        L[:, -1] = 0.0
+    order = np.arange(len(route))
+
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        two_opt_delta, i, j = best_two_opt_move(order, L)
+        or_opt_delta, p, s, q, reverse = best_or_opt_move(order, L)
+        if min(two_opt_delta, or_opt_delta) >= -IMPROVEMENT_EPS:
+            break
+        if two_opt_delta <= or_opt_delta:
+            order = np.concatenate((order[:i + 1], order[i + 1:j + 1][::-1], order[j + 1:]))
+        else:
+            order = apply_or_opt_move(order, p, s, q, reverse)
+        iteration += 1
+
+    return [route[k] for k in order.tolist()]
+
+
+# Number of nearest neighbours of each customer the inter-route moves are evaluated with
+GRANULAR_NEIGHBOURS = 10
+# Longest segments exchanged between two routes by CROSS moves. CROSS moves of two single customers are swaps.
+CROSS_MAX_SEGMENT_LENGTH = 3
+
+RELOCATE_AFTER = "relocate after"
+RELOCATE_BEFORE = "relocate before"
+TWO_OPT_STAR = "2-opt*"
+CROSS = "cross"
+
+
+class InterRouteSearch:
+    """Granular inter-route local search over the routes of a solution: relocate, swap, 2-opt* (tail exchange) and
+    CROSS (segment exchange) moves between two routes. Only the moves that create an arc between a customer and one of
+    its `neighbours` nearest customers are evaluated, all of the neighbours of a customer at once with NumPy, so one
+    pass over the customers costs O(N k).
+
+    Node 0 is the depot, coordinates and demands are indexed by node. routes is a list of routes [0, ..., 0]. The
+    route, position, predecessor, successor and route prefix load of every customer are kept in arrays, as are the
+    load and cost of every route, so each capacity check and move evaluation takes O(1) and applying a move only
+    updates the two routes involved. If round_distances is set, distances are rounded to whole units as in
+    create_distance_matrix. If return_to_depot is False, arcs into the depot cost nothing (as in the distances
+    reported by run_vehicle_routing_savings)."""
+
+    def __init__(self, coordinates, demands, vehicle_cap, routes, neighbours=GRANULAR_NEIGHBOURS,
+                 round_distances=False, return_to_depot=True):
+        coordinates = np.asarray(coordinates, dtype=float)
+        self.x, self.y = coordinates[:, 0], coordinates[:, 1]
+        self.demands = np.asarray(demands, dtype=float)
+        self.vehicle_cap = vehicle_cap
+        self.round_distances = round_distances
+        self.return_to_depot = return_to_depot
+        self.moves = {RELOCATE_AFTER: 0, RELOCATE_BEFORE: 0, TWO_OPT_STAR: 0, CROSS: 0}
+
+        self.routes = [list(r[1:-1]) for r in routes if len(r) > 2]
+        n = len(coordinates)
+        self.route_of = np.full(n, -1, dtype=np.int64)
+        self.position_of = np.zeros(n, dtype=np.int64)
+        self.previous_node = np.zeros(n, dtype=np.int64)
+        self.next_node = np.zeros(n, dtype=np.int64)
+        self.prefix_load = np.zeros(n)
+        self.loads = np.zeros(len(self.routes))
+        self.costs = np.zeros(len(self.routes))
+        for r in range(len(self.routes)):
+            self._update_route(r)
+
+        self.customers = np.flatnonzero(self.route_of >= 0)
+        k = min(neighbours, len(self.customers) - 1)
+        self.neighbours = np.zeros((n, max(k, 0)), dtype=np.int64)
+        if k > 0:
+            customer_coordinates = coordinates[self.customers]
+            _, nearest = cKDTree(customer_coordinates).query(customer_coordinates, k=k + 1)
+            # drop each customer from its own list (it is not always first if there are duplicate locations)
+            not_self = nearest != np.arange(len(self.customers))[:, np.newaxis]
+            nearest = np.take_along_axis(nearest, np.argsort(~not_self, axis=1, kind='stable')[:, :k], axis=1)
+            self.neighbours[self.customers] = self.customers[nearest]
+
+    def distances(self, a, b):
+        """Distances of the arcs a -> b (nodes or arrays of nodes)"""
+        d = np.hypot(self.x[a] - self.x[b], self.y[a] - self.y[b])
+        if self.round_distances:
+            d = np.rint(d)
+        if not self.return_to_depot:
+            d = np.where(np.asarray(b) == 0, 0.0, d)
+        return d
+
+    def _update_route(self, r):
+        route = self.routes[r]
+        nodes = np.array(route, dtype=np.int64)
+        if not len(nodes):
+            self.loads[r] = self.costs[r] = 0.0
+            return
+        self.route_of[nodes] = r
+        self.position_of[nodes] = np.arange(len(nodes))
+        self.previous_node[nodes] = np.concatenate(([0], nodes[:-1]))
+        self.next_node[nodes] = np.concatenate((nodes[1:], [0]))
+        self.prefix_load[nodes] = np.cumsum(self.demands[nodes])
+        self.loads[r] = self.demands[nodes].sum()
+        closed = np.concatenate(([0], nodes, [0]))
+        self.costs[r] = self.distances(closed[:-1], closed[1:]).sum()
+
+    def _segment_ends(self, start, length):
+        """Last nodes of the segments of `length` customers starting at the nodes `start`, 0 where the route ends
+        first"""
+        end = np.array(start, dtype=np.int64)
+        for _ in range(length - 1):
+            end = np.where(end == 0, 0, self.next_node[end])
+        return end
+
+    def best_move(self, u):
+        """Evaluates the moves between customer u and its neighbours in other routes. Returns the best one as
+        (delta, kind, v, l1, l2), where l1 and l2 are the segment lengths of CROSS moves."""
+        best_move = (0.0, None, 0, 0, 0)
+        v = self.neighbours[u]
+        v = v[self.route_of[v] != self.route_of[u]]
+        if not len(v):
+            return best_move
+        r1, r2 = self.route_of[u], self.route_of[v]
+        d = self.distances
+        u_previous, u_next = self.previous_node[u], self.next_node[u]
+        v_previous, v_next = self.previous_node[v], self.next_node[v]
+        fits = self.loads[r2] + self.demands[u] <= self.vehicle_cap
+
+        def consider(kind, delta, l1=0, l2=0):
+            nonlocal best_move
+            best = int(np.argmin(delta))
+            if delta[best] < best_move[0]:
+                best_move = (float(delta[best]), kind, int(v[best]), l1, l2)
+
+        # relocate u next to v
+        removal = d(u_previous, u_next) - d(u_previous, u) - d(u, u_next)
+        consider(RELOCATE_AFTER, np.where(fits, removal + d(v, u) + d(u, v_next) - d(v, v_next), np.inf))
+        consider(RELOCATE_BEFORE, np.where(fits, removal + d(v_previous, u) + d(u, v) - d(v_previous, v), np.inf))
+
+        # 2-opt*: the tail of r1 after u is exchanged with the tail of r2 from v
+        v_tail_load = self.loads[r2] - self.prefix_load[v] + self.demands[v]
+        u_tail_load = self.loads[r1] - self.prefix_load[u]
+        fits = (self.prefix_load[u] + v_tail_load <= self.vehicle_cap) & \
+               (self.loads[r2] - v_tail_load + u_tail_load <= self.vehicle_cap)
+        consider(TWO_OPT_STAR, np.where(fits, d(u, v) + d(v_previous, u_next) - d(u, u_next) - d(v_previous, v),
+                                        np.inf))
+
+        # CROSS: the l1 customers after u are exchanged with the l2 customers from v
+        for l1 in range(1, CROSS_MAX_SEGMENT_LENGTH + 1):
+            first = u_next
+            last = int(self._segment_ends(first, l1)) if first else 0
+            if not last:
+                break
+            following = self.next_node[last]
+            u_segment_load = self.prefix_load[last] - self.prefix_load[u]
+            for l2 in range(1, CROSS_MAX_SEGMENT_LENGTH + 1):
+                v_last = self._segment_ends(v, l2)
+                v_following = self.next_node[v_last]
+                v_segment_load = self.prefix_load[v_last] - self.prefix_load[v] + self.demands[v]
+                fits = (v_last != 0) & (self.loads[r1] - u_segment_load + v_segment_load <= self.vehicle_cap) & \
+                       (self.loads[r2] - v_segment_load + u_segment_load <= self.vehicle_cap)
+                delta = d(u, v) + d(v_last, following) + d(v_previous, first) + d(last, v_following) - \
+                    d(u, first) - d(last, following) - d(v_previous, v) - d(v_last, v_following)
+                consider(CROSS, np.where(fits, delta, np.inf), l1, l2)
+
+        return best_move
+
+    def apply_move(self, u, move):
+        _, kind, v, l1, l2 = move
+        r1, r2 = int(self.route_of[u]), int(self.route_of[v])
+        route1, route2 = self.routes[r1], self.routes[r2]
+        pu, pv = int(self.position_of[u]), int(self.position_of[v])
+        if kind == RELOCATE_AFTER or kind == RELOCATE_BEFORE:
+            route1 = route1[:pu] + route1[pu + 1:]
+            position = pv + 1 if kind == RELOCATE_AFTER else pv
+            route2 = route2[:position] + [u] + route2[position:]
+        elif kind == TWO_OPT_STAR:
+            route1, route2 = route1[:pu + 1] + route2[pv:], route2[:pv] + route1[pu + 1:]
+        else:
+            route1, route2 = route1[:pu + 1] + route2[pv:pv + l2] + route1[pu + 1 + l1:], \
+                             route2[:pv] + route1[pu + 1:pu + 1 + l1] + route2[pv + l2:]
+        self.routes[r1], self.routes[r2] = route1, route2
+        self._update_route(r1)
+        self._update_route(r2)
+        self.moves[kind] += 1
+
+    def run(self, max_passes=None, time_limit=None):
+        """Applies the best improving move of each customer in turn, until a pass over all the customers finds no
+        improving move (or after max_passes passes, or once time_limit seconds have passed). Returns the improved
+        routes [0, ..., 0]."""
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        passes = 0
+        improved = True
+        while improved and (max_passes is None or passes < max_passes):
+            improved = False
+            for u in self.customers.tolist():
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return self.solution()
+                move = self.best_move(u)
+                if move[0] < -IMPROVEMENT_EPS:
+                    self.apply_move(u, move)
+                    improved = True
+            passes += 1
+        return self.solution()
+
+    def solution(self):
+        return [[0] + route + [0] for route in self.routes if route]
+
+    def total_cost(self):
+        return float(self.costs.sum())
+
+
+def inter_route_search(routes, coordinates, demands, vehicle_cap, neighbours=GRANULAR_NEIGHBOURS,
+                       round_distances=False, return_to_depot=True, max_passes=None, time_limit=None):
+    """Improves the routes [0, ..., 0] of a solution with InterRouteSearch. Returns the improved routes."""
+    return InterRouteSearch(coordinates, demands, vehicle_cap, routes, neighbours, round_distances,
+                            return_to_depot).run(max_passes, time_limit)
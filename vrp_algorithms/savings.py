@@ -2,19 +2,25 @@ from __future__ import print_function
 from __future__ import division
 import json
 from math import degrees, atan2, sqrt
-from scipy.spatial import distance_matrix
+from scipy.spatial import distance_matrix, cKDTree
 import numpy as np
 import datetime
 from pathlib import Path
 from builtins import range
 import os
+from functools import partial
+import heapq
 
 import matplotlib as mpl
 import matplotlib.font_manager as font_manager
 
 
 from logging import log, DEBUG
+import time
+from concurrent.futures import wait
 from utilities.utils import routes2sol, objf
+from utilities.pool_utils import get_process_pool, share_array, attach_array, map_in_chunks
+from vrp_algorithms.local_search import improve_route, inter_route_search
 
 S_EPS = 1e-10
 C_EPS = 1e-10
@@ -94,6 +100,41 @@ def create_distance_matrix(customer_list):
     return matrix
 
 
+class CoordinateDistances:
+    """Lazy stand-in for the matrix returned by create_distance_matrix. Distances are rounded Euclidean distances
+    computed on demand from the coordinates, so that instances too large for a dense N x N matrix can still be indexed
+    as D[i, j] (with scalar i and j) by parallel_savings_init."""
+
+    def __init__(self, coordinates):
+        self.coordinates = np.asarray(coordinates, dtype=float)
+        self._x = self.coordinates[:, 0].tolist()
+        self._y = self.coordinates[:, 1].tolist()
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def __getitem__(self, index):
+        i, j = index
+        dx = self._x[i] - self._x[j]
+        dy = self._y[i] - self._y[j]
+        return float(round(sqrt(dx * dx + dy * dy)))
+
+    def pairs(self, i, j):
+        """Distances for the index arrays i and j"""
+        diff = self.coordinates[i] - self.coordinates[j]
+        return np.rint(np.sqrt((diff * diff).sum(axis=-1)))
+
+    def rows(self, start, stop):
+        """Dense block D[start:stop, :] of the distance matrix"""
+        diff = self.coordinates[start:stop, np.newaxis, :] - self.coordinates[np.newaxis, :, :]
+        return np.rint(np.sqrt((diff * diff).sum(axis=-1)))
+
+
+def create_coordinate_distances(customer_list):
+    """Takes in as argument a list of Customers, returns a CoordinateDistances instance"""
+    return CoordinateDistances([(float(i.pos.x), float(i.pos.y)) for i in customer_list])
+
+
 def print_tuple(t):
     print("["),
     for i in t:
@@ -219,8 +260,387 @@ def clarke_wright_savings_function(D):
     return savings
 
 
+# Compact record layout for a sorted savings list: 12 bytes per customer pair instead of a Python tuple of four
+# boxed objects.
+SAVINGS_DTYPE = np.dtype([('saving', np.float32), ('i', np.int32), ('j', np.int32)])
+SAVINGS_CHUNK_SIZE = 4096
+
+
+def sort_savings_array(s, d, i, j):
+    """Orders the savings s of the pairs (i, j) with distances d exactly as clarke_wright_savings_function would sort
+    its (s, -D[i,j], i, j) tuples (i.e. in reverse) and packs them into a SAVINGS_DTYPE record array. The keys are
+    compared in full precision, only the stored saving is downcast."""
+    # np.lexsort uses the last key as the primary one
+    order = np.lexsort((-j, -i, d, -s))
+    savings = np.empty(len(order), dtype=SAVINGS_DTYPE)
+    savings['saving'] = s[order]
+    savings['i'] = i[order]
+    savings['j'] = j[order]
+    return savings
+
+
+def clarke_wright_savings_array(D):
+    """Vectorised version of clarke_wright_savings_function. The upper triangle savings
+    s_ij = D[i,0] + D[0,j] - D[i,j] are built with NumPy broadcasting and returned as a SAVINGS_DTYPE record array in
+    the same merge order."""
+    D = np.asarray(D, dtype=float)
+    N = len(D)
+    i, j = np.triu_indices(N - 1, k=1)
+    i += 1
+    j += 1
+    d = D[i, j]
+    s = D[i, 0] + D[0, j] - d
+    return sort_savings_array(s, d, i, j)
+
+
+def parametric_savings_array(D, lam=1.0, noise=0.0, seed=None):
+    """Parametric (lambda) savings s_ij = D[i,0] + D[0,j] - lam * D[i,j], optionally perturbed by a uniform relative
+    noise of at most `noise` (drawn with the given seed). With lam = 1 and noise = 0 this gives the same order as
+    clarke_wright_savings_array.
+
+    The pairs with a negative Clarke-Wright saving are left out: parallel_savings_init stops at the first one, which
+    in this order can come before pairs that still save distance."""
+    D = np.asarray(D, dtype=float)
+    N = len(D)
+    i, j = np.triu_indices(N - 1, k=1)
+    i += 1
+    j += 1
+    d = D[i, j]
+    keep = D[i, 0] + D[0, j] - d >= 0.0
+    i, j, d = i[keep], j[keep], d[keep]
+    s = D[i, 0] + D[0, j] - lam * d
+    if noise:
+        s *= 1.0 + np.random.default_rng(seed).uniform(-noise, noise, len(s))
+    return sort_savings_array(s, d, i, j)
+
+
+class SavingsVariants:
+    """Savings variant engine. The terms shared by the savings variants (D[i,0], D[0,j], D[i,j] and the demands of the
+    upper triangle pairs) are computed once, and the merge order of each variant is then derived from them with a
+    single vectorised expression and sort. All methods return SAVINGS_DTYPE record arrays for parallel_savings_init.
+
+    Gaskell, T. J. (1967). Bases for vehicle fleet scheduling. Operational Research Quarterly, 18(3), 281-295.
+    Yellow, P. C. (1970). A computational modification to the savings method of vehicle scheduling. Operational
+     Research Quarterly, 21(2), 281-283.
+    Altinel, I. K. and Oncan, T. (2005). A new enhancement of the Clarke and Wright savings heuristic for the
+     capacitated vehicle routing problem. Journal of the Operational Research Society, 56(8), 954-961.
+    """
+
+    def __init__(self, D, demand_list=None):
+        D = np.asarray(D, dtype=float)
+        N = len(D)
+        i, j = np.triu_indices(N - 1, k=1)
+        self.i = i + 1
+        self.j = j + 1
+        self.d = D[self.i, self.j]
+        self.d0i = D[self.i, 0]
+        self.d0j = D[0, self.j]
+        self.cw = self.d0i + self.d0j - self.d
+        self.asymmetry = np.abs(self.d0i - self.d0j)
+        self.average_depot_distance = D[0, 1:].mean() if N > 1 else 0.0
+        if demand_list is not None and N > 1:
+            demands = np.asarray(demand_list, dtype=float)
+            average_demand = demands[1:].mean()
+            self.demand_term = (demands[self.i] + demands[self.j]) / (average_demand if average_demand else 1.0)
+        else:
+            self.demand_term = None
+
+    def _sorted(self, s):
+        # parallel_savings_init stops at the first pair with a negative Clarke-Wright saving, which the other orders
+        # can put before pairs that still save distance, so those pairs are left out
+        keep = self.cw >= 0.0
+        return sort_savings_array(s[keep], self.d[keep], self.i[keep], self.j[keep])
+
+    def clarke_wright(self):
+        return self._sorted(self.cw)
+
+    def parametric(self, lam=1.0, mu=0.0, nu=0.0):
+        """s_ij = D[i,0] + D[0,j] - lam D[i,j] + mu |D[0,i] - D[0,j]| + nu (q_i + q_j) / mean(q) (Altinel and Oncan)"""
+        s = self.d0i + self.d0j - lam * self.d
+        if mu:
+            s = s + mu * self.asymmetry
+        if nu:
+            if self.demand_term is None:
+                raise ValueError("The demand term (nu) of the savings requires the demand_list")
+            s = s + nu * self.demand_term
+        return self._sorted(s)
+
+    def yellow(self, gamma=1.0):
+        """Yellow's route shape savings s_ij = D[i,0] + D[0,j] - gamma D[i,j]"""
+        return self.parametric(lam=gamma)
+
+    def gaskell_lambda(self):
+        """Gaskell's lambda savings s_ij (d_avg + |D[0,i] - D[0,j]| - D[i,j]), with d_avg the mean depot distance"""
+        return self._sorted(self.cw * (self.average_depot_distance + self.asymmetry - self.d))
+
+    def gaskell_pi(self):
+        """Gaskell's pi savings D[i,0] + D[0,j] - 2 D[i,j]"""
+        return self.parametric(lam=2.0)
+
+    def savings(self, variant):
+        """Savings of a variant given either by name ("clarke_wright", "yellow", "gaskell_lambda", "gaskell_pi") or as
+        a dict of keyword arguments of parametric (lam, mu, nu)"""
+        if isinstance(variant, dict):
+            return self.parametric(**variant)
+        return getattr(self, variant)()
+
+
+def savings_parameter_grid(lams=(0.6, 0.8, 1.0, 1.2, 1.4), mus=(0.0, 0.5, 1.0), nus=(0.0, 0.5, 1.0)):
+    """Returns the (lam, mu, nu) grid of parametric savings variants as a list of dicts for batch_savings_variants"""
+    return [{"lam": lam, "mu": mu, "nu": nu} for lam in lams for mu in mus for nu in nus]
+
+
+# Default number of nearest neighbours kept per customer by the sparse (granular) savings.
+NEIGHBOURHOOD_SIZE = 20
+
+
+def neighbour_savings_array(D, k=NEIGHBOURHOOD_SIZE):
+    """Sparse (granular) Clarke-Wright savings. Only the pairs (i, j) where j is one of the k nearest customers of i
+    (or vice versa) get a saving, which reduces the savings list from O(N^2) to O(N k) pairs. The neighbours are found
+    with a cKDTree over the customer coordinates, so D must be a CoordinateDistances instance. The pairs are returned as
+    a SAVINGS_DTYPE record array in the same order clarke_wright_savings_array would give them."""
+    customer_coordinates = D.coordinates[1:]
+    N = len(D)
+    k = min(k, N - 2)
+    if k < 1:
+        return np.empty(0, dtype=SAVINGS_DTYPE)
+
+    # the nearest neighbour of each customer is itself (unless there are duplicate locations, which is handled below)
+    _, neighbours = cKDTree(customer_coordinates).query(customer_coordinates, k=k + 1)
+    i = np.repeat(np.arange(1, N), k + 1)
+    j = neighbours.ravel() + 1
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    # drop the self pairs and the pairs found from both ends
+    pair_keys = np.unique((i.astype(np.int64) * N + j)[i != j])
+    i = pair_keys // N
+    j = pair_keys % N
+
+    depot = np.zeros(N, dtype=int)
+    depot_distances = D.pairs(np.arange(N), depot)
+    d = D.pairs(i, j)
+    s = depot_distances[i] + depot_distances[j] - d
+    return sort_savings_array(s, d, i, j)
+
+
+# Default memory budget (in MB) of blockwise_savings_stream, and the approximate number of bytes it needs per distance
+# matrix entry while computing a block and per kept savings candidate.
+SAVINGS_MEMORY_BUDGET_MB = 256
+BLOCK_BYTES_PER_ENTRY = 64
+CANDIDATE_BYTES = 40
+
+
+def distance_rows(D, start, stop):
+    """Dense block D[start:stop, :] of either a distance matrix or a CoordinateDistances instance"""
+    if isinstance(D, CoordinateDistances):
+        return D.rows(start, stop)
+    return np.asarray(D[start:stop], dtype=float)
+
+
+def _after_key(s, d, i, j, key):
+    """Mask of the savings that come strictly after key = (s, d, i, j) in the merge order"""
+    key_s, key_d, key_i, key_j = key
+    return (s < key_s) | ((s == key_s) & ((d > key_d) | ((d == key_d) & ((i < key_i) | ((i == key_i) & (j < key_j))))))
+
+
+def _block_candidates(D, depot_distances, start, stop, after, max_candidates):
+    """Computes the non-negative savings of the row block [start, stop) and returns (s, d, i, j) arrays of the (at most
+    max_candidates) best ones that come after the key `after`, in merge order, as well as a flag that is True if the
+    block has no savings left after them."""
+    block = distance_rows(D, start, stop)
+    i, j = np.nonzero(np.arange(start, stop)[:, np.newaxis] < np.arange(block.shape[1])[np.newaxis, :])
+    d = block[i, j]
+    i = i + start
+    s = depot_distances[i] + depot_distances[j] - d
+    del block
+
+    keep = s >= 0.0
+    if after is not None:
+        keep &= _after_key(s, d, i, j, after)
+    s, d, i, j = s[keep], d[keep], i[keep], j[keep]
+
+    exhausted = len(s) <= max_candidates
+    if not exhausted:
+        # only the savings that can be among the max_candidates best have to be sorted
+        threshold = np.partition(s, len(s) - max_candidates)[len(s) - max_candidates]
+        keep = s >= threshold
+        s, d, i, j = s[keep], d[keep], i[keep], j[keep]
+
+    order = np.lexsort((-j, -i, d, -s))[:max_candidates]
+    return s[order].tolist(), d[order].tolist(), i[order].tolist(), j[order].tolist(), exhausted
+
+
+def blockwise_savings_stream(D, memory_budget_mb=SAVINGS_MEMORY_BUDGET_MB):
+    """Out-of-core Clarke-Wright savings. Instead of building (and sorting) all O(N^2) savings, the distances and
+    savings are computed in blocks of rows of D, of which only the best candidates are kept. The blocks are merged with
+    a heap that holds one candidate per block, and the savings are yielded lazily, best first, as (s, -D[i,j], i, j)
+    tuples. Once the kept candidates of a block run out, the block is recomputed to get the next best ones. Peak
+    memory is bounded by memory_budget_mb, at the cost of recomputing blocks.
+
+    The order is exactly that of clarke_wright_savings_array. Negative savings are not yielded, as
+    parallel_savings_init stops at the first one anyway. D can be a distance matrix, but to avoid the dense matrix
+    altogether it should be a CoordinateDistances instance."""
+    N = len(D)
+    if N < 3:
+        return
+
+    budget = memory_budget_mb * 1024 * 1024
+    # half of the budget is used to compute a block, the other half to keep the candidates of all the blocks
+    block_size = int(max(1, min(N - 1, budget // 2 // (BLOCK_BYTES_PER_ENTRY * N))))
+    block_starts = list(range(1, N - 1, block_size))
+    max_candidates = int(max(1, budget // 2 // (CANDIDATE_BYTES * len(block_starts))))
+
+    depot_distances = distance_rows(D, 0, 1)[0]
+
+    # per block: candidate lists, position of the next candidate, and whether the block has been exhausted
+    buffers = [None] * len(block_starts)
+    positions = [0] * len(block_starts)
+    exhausted = [False] * len(block_starts)
+    heap = []
+
+    def push_next(block_idx, after):
+        if buffers[block_idx] is None or positions[block_idx] == len(buffers[block_idx][0]):
+            if exhausted[block_idx]:
+                return
+            start = block_starts[block_idx]
+            stop = min(start + block_size, N - 1)
+            *candidates, exhausted[block_idx] = _block_candidates(D, depot_distances, start, stop, after,
+                                                                  max_candidates)
+            buffers[block_idx] = candidates
+            positions[block_idx] = 0
+            if not candidates[0]:
+                return
+        s, d, i, j = (candidates[positions[block_idx]] for candidates in buffers[block_idx])
+        positions[block_idx] += 1
+        heapq.heappush(heap, (-s, d, -i, -j, block_idx))
+
+    for block_idx in range(len(block_starts)):
+        push_next(block_idx, None)
+
+    while heap:
+        neg_s, d, neg_i, neg_j, block_idx = heapq.heappop(heap)
+        yield -neg_s, -d, -neg_i, -neg_j
+        push_next(block_idx, (-neg_s, d, -neg_i, -neg_j))
+
+
+def iterate_savings(savings, excluded=None):
+    """Yields (saving, i, j) triples from either a list of (s, -D[i,j], i, j) tuples (or any iterator of them) or a
+    SAVINGS_DTYPE record array. Record arrays are converted to Python scalars in chunks, as the merge loop usually
+    stops long before the end of the list. The pairs with the node excluded are skipped (masked out chunk by chunk for
+    record arrays), so the same sorted savings can be reused without one of the customers."""
+    if isinstance(savings, np.ndarray):
+        for start in range(0, len(savings), SAVINGS_CHUNK_SIZE):
+            chunk = savings[start:start + SAVINGS_CHUNK_SIZE]
+            if excluded is not None:
+                chunk = chunk[(chunk['i'] != excluded) & (chunk['j'] != excluded)]
+            yield from zip(chunk['saving'].tolist(), chunk['i'].tolist(), chunk['j'].tolist())
+    else:
+        for s, _, i, j in savings:
+            if i != excluded and j != excluded:
+                yield s, i, j
+
+
+# Reasons passed to MergeObserver.on_reject
+REJECT_NOT_ENDPOINTS = "not_endpoints"
+REJECT_CAPACITY = "capacity"
+REJECT_DISTANCE = "distance"
+
+
+class MergeObserver:
+    """Instrumentation hooks of the merge loop of parallel_savings_init. The hooks do nothing; subclasses override
+    the ones they need."""
+
+    def on_savings(self, seconds):
+        """Called once the savings have been computed, with the time it took"""
+
+    def on_saving(self, saving, i, j):
+        """Called for every saving popped from the savings list"""
+
+    def on_merge(self, saving, i, j, left_route, right_route):
+        """Called when the routes ending at i and j are merged into left_route"""
+
+    def on_reject(self, saving, i, j, reason):
+        """Called when the merge of i and j is rejected. reason is REJECT_NOT_ENDPOINTS if i or j is not an endpoint
+        (or both are endpoints of the same route), REJECT_CAPACITY or REJECT_DISTANCE if the merged route would violate
+        the capacity or maximum route length constraint."""
+
+    def on_finish(self, sol, seconds):
+        """Called with the final solution and the time spent in the merge loop"""
+
+
+class MergeStatistics(MergeObserver):
+    """Counts the popped savings, accepted merges and rejected merges (per reason) and times the savings computation
+    and the merge loop of parallel_savings_init"""
+
+    def __init__(self):
+        self.savings_popped = 0
+        self.merges_accepted = 0
+        self.rejected = {REJECT_NOT_ENDPOINTS: 0, REJECT_CAPACITY: 0, REJECT_DISTANCE: 0}
+        self.savings_seconds = 0.0
+        self.merge_seconds = 0.0
+
+    def on_savings(self, seconds):
+        self.savings_seconds += seconds
+
+    def on_saving(self, saving, i, j):
+        self.savings_popped += 1
+
+    def on_merge(self, saving, i, j, left_route, right_route):
+        self.merges_accepted += 1
+
+    def on_reject(self, saving, i, j, reason):
+        self.rejected[reason] += 1
+
+    def on_finish(self, sol, seconds):
+        self.merge_seconds += seconds
+
+    def as_dict(self):
+        return {"savings_popped": self.savings_popped, "merges_accepted": self.merges_accepted,
+                "rejected_not_endpoints": self.rejected[REJECT_NOT_ENDPOINTS],
+                "rejected_capacity": self.rejected[REJECT_CAPACITY],
+                "rejected_distance": self.rejected[REJECT_DISTANCE],
+                "savings_seconds": self.savings_seconds, "merge_seconds": self.merge_seconds}
+
+    def __str__(self):
+        return ", ".join("%s: %s" % item for item in self.as_dict().items())
+
+
+class LoggingMergeObserver(MergeObserver):
+    """Logs the merge loop of parallel_savings_init at the given logging level (the former inline debug output)"""
+
+    def __init__(self, level=DEBUG - 1):
+        self.level = level
+
+    def on_saving(self, saving, i, j):
+        log(self.level, "Popped savings s_{%d,%d}=%.2f" % (i, j, saving))
+
+    def on_merge(self, saving, i, j, left_route, right_route):
+        log(self.level, "Merged route #%d into route #%d over %d-%d" % (right_route, left_route, i, j))
+
+    def on_reject(self, saving, i, j, reason):
+        log(self.level, "Reject merge of %d-%d due to %s" % (i, j, reason))
+
+    def on_finish(self, sol, seconds):
+        log(self.level, "Resulting solution is %s" % str(sol))
+
+
+def walk_route(start, neighbour_a, neighbour_b):
+    """Returns the route of the doubly linked list (see parallel_savings_init) that starts at node start as a list"""
+    route = []
+    previous_node, node = 0, start
+    while node:
+        route.append(node)
+        next_node = neighbour_a[node] if neighbour_a[node] != previous_node else neighbour_b[node]
+        previous_node, node = node, next_node
+    return route
+
+
+def linked_routes(route_start, neighbour_a, neighbour_b):
+    """Converts the doubly linked routes of parallel_savings_init to a list of routes (None for merged routes)"""
+    return [walk_route(start, neighbour_a, neighbour_b) if start is not None else None for start in route_start]
+
+
 def parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity, max_allowable_distance=None,
-                          savings_callback=clarke_wright_savings_function):
+                          savings_callback=clarke_wright_savings_array, observer=None, excluded=None):
     """
     Implementation of the basic savings algorithm / construction heuristic for
     capaciated vehicle routing problems with symmetric distances (see, e.g.
@@ -233,6 +653,16 @@ def parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity,
     * demand_list is a list of demands. demand_list[0] should be 0.0 as it is the depot.
     * vehicle_capacity is the capacity constraint limit for the identical vehicles.
     * max_allowable_distance is the optional constraint for the maximum route length/duration/cost.
+    * savings_callback returns the sorted savings for distance_matrix_input, either as a list of (s, -D[i,j], i, j)
+      tuples (see clarke_wright_savings_function) or as a SAVINGS_DTYPE record array (see
+      clarke_wright_savings_array).
+    * observer is an optional MergeObserver that is notified of every popped
+      saving, accepted merge and rejected merge (see MergeStatistics). Without
+      an observer the merge loop does no tracing work at all.
+    * excluded is an optional customer that is left out of the solution: it
+      gets no route and its savings are skipped. The solution is the one
+      without that customer in the distance matrix (in the original node
+      indices), but the matrix and the savings do not have to be rebuilt.
 
 
     See clarke_wright_savings.py, gaskell_savings.py, yellow_savings.py etc.
@@ -253,23 +683,38 @@ def parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity,
     ignore_negative_savings = not False
 
     ## 1. make route for each customer
-    routes = [[i] for i in range(1, N)]
+    # The routes are kept as doubly linked lists: neighbour_a and neighbour_b
+    #  hold the two neighbours of each node (0, the depot, if there is none),
+    #  route_start the first node of each route (None once it is merged into
+    #  another route) and other_end the opposite endpoint of each endpoint.
+    #  Merging two routes, including the reversals, is then O(1).
+    route_start = list(range(1, N))
+    other_end = list(range(N))
+    neighbour_a = [0] * N
+    neighbour_b = [0] * N
     route_demands = demand_list[1:] if vehicle_capacity else [0] * N
     if max_allowable_distance: route_costs = [distance_matrix_input[0, i] + distance_matrix_input[i, 0] for i in range(1, N)]
+    if excluded is not None:
+        route_start[excluded - 1] = None
 
     try:
         ## 2. compute initial savings
+        if observer is not None:
+            savings_tic = time.perf_counter()
         savings = savings_callback(distance_matrix_input)
+        if observer is not None:
+            merge_tic = time.perf_counter()
+            observer.on_savings(merge_tic - savings_tic)
 
         # zero based node indexing!
         endnode_to_route = [0] + list(range(0, N - 1))
 
         ## 3. merge
-        # Get potential merges best savings first (second element is secondary
-        #  sorting criterion, and it it ignored)
-        for best_saving, _, i, j in savings:
-            if __debug__:
-                log(DEBUG - 1, "Popped savings s_{%d,%d}=%.2f" % (i, j, best_saving))
+        # Get potential merges best savings first (the secondary sorting
+        #  criterion is dropped by iterate_savings)
+        for best_saving, i, j in iterate_savings(savings, excluded):
+            if observer is not None:
+                observer.on_saving(best_saving, i, j)
 
             if ignore_negative_savings:
                 cw_saving = distance_matrix_input[i, 0] + distance_matrix_input[0, j] - distance_matrix_input[i, j]
@@ -283,21 +728,16 @@ def parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity,
             if ((left_route is None) or
                     (right_route is None) or
                     (left_route == right_route)):
+                if observer is not None:
+                    observer.on_reject(best_saving, i, j, REJECT_NOT_ENDPOINTS)
                 continue
 
-            if __debug__:
-                log(DEBUG - 1, "Route #%d : %s" %
-                    (left_route, str(routes[left_route])))
-                log(DEBUG - 1, "Route #%d : %s" %
-                    (right_route, str(routes[right_route])))
-
             # check capacity constraint validity
             if vehicle_capacity:
                 merged_demand = route_demands[left_route] + route_demands[right_route]
                 if merged_demand - C_EPS > vehicle_capacity:
-                    if __debug__:
-                        log(DEBUG - 1, "Reject merge due to " +
-                            "capacity constraint violation")
+                    if observer is not None:
+                        observer.on_reject(best_saving, i, j, REJECT_CAPACITY)
                     continue
             # if there are route cost constraint, check its validity
             if max_allowable_distance:
@@ -305,59 +745,141 @@ def parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity,
                               route_costs[right_route] - distance_matrix_input[0, j] + \
                               distance_matrix_input[i, j]
                 if merged_cost - S_EPS > max_allowable_distance:
-                    if __debug__:
-                        log(DEBUG - 1, "Reject merge due to " +
-                            "maximum route length constraint violation")
+                    if observer is not None:
+                        observer.on_reject(best_saving, i, j, REJECT_DISTANCE)
                     continue
 
             # update bookkeeping only on the recieving (left) route
             if vehicle_capacity: route_demands[left_route] = merged_demand
             if max_allowable_distance: route_costs[left_route] = merged_cost
 
-            # merging is done based on the joined endpoints, reverse the
-            #  merged routes as necessary
-            if routes[left_route][0] == i:
-                routes[left_route].reverse()
-            if routes[right_route][-1] == j:
-                routes[right_route].reverse()
+            # merging is done based on the joined endpoints: the merged route
+            #  runs from the far end of the left route over i and j to the far
+            #  end of the right route
+            left_end = other_end[i]
+            right_end = other_end[j]
+            route_start[left_route] = left_end
+            route_start[right_route] = None
+            other_end[left_end] = right_end
+            other_end[right_end] = left_end
+
+            # link i and j through their free neighbour slots
+            if neighbour_a[i] == 0:
+                neighbour_a[i] = j
+            else:
+                neighbour_b[i] = j
+            if neighbour_a[j] == 0:
+                neighbour_a[j] = i
+            else:
+                neighbour_b[j] = i
 
             # the nodes that become midroute points cannot be merged
-            if len(routes[left_route]) > 1:
-                endnode_to_route[routes[left_route][-1]] = None
-            if len(routes[right_route]) > 1:
-                endnode_to_route[routes[right_route][0]] = None
+            if left_end != i:
+                endnode_to_route[i] = None
+            if right_end != j:
+                endnode_to_route[j] = None
 
             # all future references to right_route are to merged route
-            endnode_to_route[routes[right_route][-1]] = left_route
+            endnode_to_route[right_end] = left_route
 
-            # merge with list concatenation
-            routes[left_route].extend(routes[right_route])
-            routes[right_route] = None
-
-            if __debug__:
-                dbg_sol = routes2sol(routes)
-                log(DEBUG - 1, "Merged, resulting solution is %s (%.2f)" %
-                    (str(dbg_sol), objf(dbg_sol, distance_matrix_input)))
+            if observer is not None:
+                observer.on_merge(best_saving, i, j, left_route, right_route)
 
     except KeyboardInterrupt:  # or SIGINT
-        interrupted_sol = routes2sol(routes)
+        interrupted_sol = routes2sol(linked_routes(route_start, neighbour_a, neighbour_b))
         raise KeyboardInterrupt(interrupted_sol)
 
-    return routes2sol(routes)
-
-
-def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
-    print("Customer data:", customerData)
-    # print("Vehicle capacity:", vehicleCapacityData)
-    # print("Depot data:", depotData)
+    sol = routes2sol(linked_routes(route_start, neighbour_a, neighbour_b))
+    if observer is not None:
+        observer.on_finish(sol, time.perf_counter() - merge_tic)
+    return sol
+
+
+def batch_savings_variants(distance_matrix_input, demand_list, vehicle_capacity, variants,
+                           max_allowable_distance=None):
+    """Runs parallel_savings_init once for each savings variant (see SavingsVariants.savings), sharing the distance
+    terms between them. Returns one dict per variant, in order, with the variant, its solution and distance, and the
+    time spent ordering the savings and merging. The time spent on the shared terms is added under "shared_seconds"
+    to every dict. Pick the best variant with e.g. min(results, key=lambda r: r["distance"])."""
+    tic = time.perf_counter()
+    engine = SavingsVariants(distance_matrix_input, demand_list)
+    shared_seconds = time.perf_counter() - tic
+
+    results = []
+    for variant in variants:
+        statistics = MergeStatistics()
+        sol = parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity, max_allowable_distance,
+                                    savings_callback=lambda _: engine.savings(variant), observer=statistics)
+        results.append({"variant": variant, "solution": sol, "distance": float(objf(sol, distance_matrix_input)),
+                        "savings_seconds": statistics.savings_seconds, "merge_seconds": statistics.merge_seconds,
+                        "shared_seconds": shared_seconds})
+    return results
+
+
+# Defaults of multi_start_savings: number of randomised starts, wall-clock budget (in seconds), range of the lambda
+# parameter and relative noise on the savings.
+MULTI_START_COUNT = 64
+MULTI_START_TIME_LIMIT = 1.0
+MULTI_START_LAMBDA_RANGE = (0.5, 1.5)
+MULTI_START_NOISE = 0.05
+
+
+def _multi_start_worker(distance_descriptor, demand_list, vehicle_capacity, max_allowable_distance, lam, noise, seed,
+                        deadline):
+    """Runs a single randomised start of multi_start_savings on the shared distance matrix. Returns the distance and
+    the solution, or None if the deadline has already passed."""
+    if time.time() > deadline:
+        return None
+    shm, D = attach_array(distance_descriptor)
+    try:
+        sol = parallel_savings_init(D, demand_list, vehicle_capacity, max_allowable_distance,
+                                    savings_callback=partial(parametric_savings_array, lam=lam, noise=noise, seed=seed))
+        return float(objf(sol, D)), sol
+    finally:
+        del D
+        shm.close()
+
+
+def multi_start_savings(distance_matrix_input, demand_list, vehicle_capacity, max_allowable_distance=None,
+                        time_limit=MULTI_START_TIME_LIMIT, n_starts=MULTI_START_COUNT, workers=None, seed=0):
+    """Multi-start randomised savings. The deterministic Clarke-Wright solution is computed first, then n_starts - 1
+    perturbed runs of parallel_savings_init (random lambda, see parametric_savings_array, and noise on the savings) are
+    spread over a pool of `workers` processes, which all read the distance matrix from the same shared memory block.
+    Returns the best solution found within time_limit seconds (wall-clock)."""
+    deadline = time.time() + time_limit
+    best_sol = parallel_savings_init(distance_matrix_input, demand_list, vehicle_capacity, max_allowable_distance)
+    best_distance = objf(best_sol, distance_matrix_input)
+
+    rng = np.random.default_rng(seed)
+    starts = [(float(rng.uniform(*MULTI_START_LAMBDA_RANGE)), MULTI_START_NOISE, int(rng.integers(2 ** 31)))
+              for _ in range(n_starts - 1)]
+    if not starts or len(distance_matrix_input) < 3:
+        return best_sol
+
+    pool = get_process_pool(workers)
+    shm, distance_descriptor = share_array(np.asarray(distance_matrix_input, dtype=float))
+    try:
+        futures = [pool.submit(_multi_start_worker, distance_descriptor, demand_list, vehicle_capacity,
+                               max_allowable_distance, lam, noise, start_seed, deadline)
+                   for lam, noise, start_seed in starts]
+        wait(futures, timeout=max(0.0, deadline - time.time()))
+        # the starts that did not make it in time are dropped (in submission order, so ties are deterministic)
+        for future in futures:
+            if not future.done() or future.cancelled():
+                future.cancel()
+                continue
+            result = future.result()
+            if result is not None and result[0] < best_distance - S_EPS:
+                best_distance, best_sol = result
+    finally:
+        shm.close()
+        shm.unlink()
 
-    #################
-    # INITIALISATION #
-    ##################
+    return best_sol
 
-    no_of_customers = len(customerData)
-    vehicle_cap = vehicleCapacityData  # This assumes that all vehicles have the same capacity.
 
+def create_customer_list(customerData, depotData):
+    """Returns the list of Customers used by the savings heuristic, with the depot as Customer(0)"""
     # create Customer object to represent the depot
     depot = Customer(0)
     depot.set_position(depotData["x"], depotData["y"])
@@ -367,15 +889,119 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
     depot.set_service_time(0)
 
     Customers = [depot]
-    for i in range(0, no_of_customers):
+    for i in range(0, len(customerData)):
         c = Customer(i + 1)
         c.set_id(int(customerData[i]["id"]))
         c.set_position(customerData[i]["x"], customerData[i]["y"])
         c.set_demand(customerData[i]["demand"])
         Customers.append(c)
+    return Customers
+
+
+def get_route_distance(route, D):
+    """Distance of a route ([0, ..., 0]) as reported by run_vehicle_routing_savings, i.e. summed over the arcs into the
+    customers of the route"""
+    return sum(D[route[index], route[index + 1]] for index in range(0, len(route) - 1) if route[index + 1])
+
+
+def get_solution_distance(sol, D):
+    """Distance of a solution as reported by run_vehicle_routing_savings (summed over the arcs into the customers)"""
+    return sum(D[sol[index], sol[index + 1]] for index in range(len(sol) - 1) if sol[index + 1]) if sol else 0
+
+
+def _savings_leave_one_out_worker(distance_descriptor, savings_descriptor, demand_list, vehicle_capacity, customers):
+    """Leave-one-out savings runs of a chunk of customers, on the shared distance matrix and sorted savings"""
+    distance_shm, D = attach_array(distance_descriptor)
+    savings_shm, savings = attach_array(savings_descriptor)
+    try:
+        return [get_solution_distance(parallel_savings_init(D, demand_list, vehicle_capacity,
+                                                            savings_callback=lambda _: savings, excluded=c), D)
+                for c in customers]
+    finally:
+        del D, savings
+        distance_shm.close()
+        savings_shm.close()
+
+
+def savings_leave_one_out_distances(customerData, vehicleCapacityData, depotData, workers=None):
+    """Leave-one-out of the savings heuristic, for calculate_distance_to_serve. Returns the total distance of
+    run_vehicle_routing_savings on all the customers, and the list of its total distances without each customer (in
+    customerData order).
+
+    The Customers, the distance matrix and the sorted savings are built once. Without a customer, the merge loop is
+    replayed over the same savings with the pairs of that customer masked out (see the excluded argument of
+    parallel_savings_init); the order of the other pairs does not change, so nothing is sorted again.
+
+    If workers is given, the customers are split in chunks over a persistent pool of that many processes, which all
+    read the distance matrix and the savings from shared memory."""
+    Customers = create_customer_list(customerData, depotData)
+    D = create_distance_matrix(Customers)
+    demands = [round(i.demand) for i in Customers]
+    vehicle_cap = round(vehicleCapacityData)
+    savings = clarke_wright_savings_array(D)
+
+    total_distance = get_solution_distance(parallel_savings_init(D, demands, vehicle_cap,
+                                                                 savings_callback=lambda _: savings), D)
+    customers = list(range(1, len(Customers)))
+    if workers is None or len(customers) < 2:
+        leave_one_out_distances = [get_solution_distance(parallel_savings_init(D, demands, vehicle_cap,
+                                                                               savings_callback=lambda _: savings,
+                                                                               excluded=c), D)
+                                   for c in customers]
+        return total_distance, leave_one_out_distances
+
+    distance_shm, distance_descriptor = share_array(D)
+    savings_shm, savings_descriptor = share_array(savings)
+    try:
+        leave_one_out_distances = map_in_chunks(_savings_leave_one_out_worker, customers, workers,
+                                                distance_descriptor, savings_descriptor, demands, vehicle_cap)
+    finally:
+        for shm in (distance_shm, savings_shm):
+            shm.close()
+            shm.unlink()
+    return total_distance, leave_one_out_distances
+
+
+def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData, neighbours=None, memory_budget_mb=None,
+                                observer=None, multi_start_time_limit=None, multi_start_workers=None,
+                                improve_routes=False, inter_route=False, time_limit=None):
+    """Runs the parallel savings heuristic on the AnyLogic data. If neighbours is given, the distance matrix is never
+    built and only the savings between each customer and its `neighbours` nearest customers are considered (see
+    neighbour_savings_array), which allows for much larger instances. If memory_budget_mb is given instead, all the
+    savings are streamed in blocks within that memory budget (see blockwise_savings_stream). An optional MergeObserver
+    (e.g. MergeStatistics) is passed on to parallel_savings_init to profile the merge loop. If multi_start_time_limit
+    is given, the best of the randomised multi_start_savings runs found within that many seconds is returned (on the
+    full distance matrix, using multi_start_workers processes).
+
+    If improve_routes is set, every route is improved with 2-opt and Or-opt moves (see local_search.improve_route),
+    and the route dicts also report the distance before the improvement as "initial_route_distance". If inter_route
+    is set, customers are first moved between the routes by local_search.inter_route_search, which stops with the
+    routes found so far once time_limit seconds (if given) have passed since the start of the call."""
+    tic = time.perf_counter()
+    print("Customer data:", customerData)
+    # print("Vehicle capacity:", vehicleCapacityData)
+    # print("Depot data:", depotData)
+
+    #################
+    # INITIALISATION #
+    ##################
+
+    vehicle_cap = vehicleCapacityData  # This assumes that all vehicles have the same capacity.
+
+    Customers = create_customer_list(customerData, depotData)
     customers_original_order = Customers[:]  # to keep track of the original customer index for later use
 
-    data = {'distance_matrix': create_distance_matrix(Customers), 'demands': [round(i.demand) for i in Customers],
+    if neighbours and not multi_start_time_limit:
+        route_distance_matrix = create_coordinate_distances(Customers)
+        savings_callback = partial(neighbour_savings_array, k=neighbours)
+    elif memory_budget_mb and not multi_start_time_limit:
+        route_distance_matrix = create_coordinate_distances(Customers)
+        savings_callback = partial(blockwise_savings_stream, memory_budget_mb=memory_budget_mb)
+    else:
+        route_distance_matrix = create_distance_matrix(Customers)
+        savings_callback = clarke_wright_savings_array
+
+    data = {'distance_matrix': route_distance_matrix, 'demands': [round(i.demand) for i in Customers],
             'num_vehicles': 10}
 
     data['vehicle_capacities'] = [round(vehicle_cap)] * data['num_vehicles']
@@ -384,7 +1010,12 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
     list_of_route_dicts_1 = []
     list_of_route_dicts_for_plot = []
 
-    routes2sol = parallel_savings_init(data['distance_matrix'], data['demands'], round(vehicle_cap))
+    if multi_start_time_limit:
+        routes2sol = multi_start_savings(data['distance_matrix'], data['demands'], round(vehicle_cap),
+                                         time_limit=multi_start_time_limit, workers=multi_start_workers)
+    else:
+        routes2sol = parallel_savings_init(data['distance_matrix'], data['demands'], round(vehicle_cap),
+                                           savings_callback=savings_callback, observer=observer)
 
     if routes2sol:
         size = len(routes2sol)
@@ -397,6 +1028,14 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
 
         routes_list.pop(0)
 
+        if inter_route:
+            # as improve_route, the moves are evaluated on the closed tours the vehicles drive
+            search_time_limit = None if time_limit is None else max(0.0, time_limit - (time.perf_counter() - tic))
+            routes_list = [r[1:] for r in inter_route_search([[0] + r for r in routes_list],
+                                                             [(c.pos.x, c.pos.y) for c in Customers],
+                                                             data['demands'], round(vehicle_cap),
+                                                             round_distances=True, time_limit=search_time_limit)]
+
         # print("After route split:", routes_list)
 
         route_number = 0
@@ -406,6 +1045,17 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
             r.insert(0, 0)
             # print("Route:", r)
 
+            if improve_routes:
+                initial_route_distance = get_route_distance(r, data['distance_matrix'])
+                # the vehicles drive closed tours, whatever the reported distance leaves out
+                improved_route = improve_route(r, data['distance_matrix'])
+                # a closed tour is as long either way round, but the reported distance is not: keep the shorter
+                # direction, and the original route if that is still shorter as reported
+                improved_route = min(improved_route, improved_route[::-1],
+                                     key=lambda route: get_route_distance(route, data['distance_matrix']))
+                if get_route_distance(improved_route, data['distance_matrix']) <= initial_route_distance:
+                    r = improved_route
+
             vehicle_route_distance = 0
 
             vehicle_route_demand = data['demands'][r[0]]
@@ -417,7 +1067,7 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
                 if r[index + 1]:
                     # print("Next customer: ", r[index + 1])
 
-                    arc_distance = data['distance_matrix'][r[index]][r[index + 1]]
+                    arc_distance = data['distance_matrix'][r[index], r[index + 1]]
                     # print("Distance: ", arc_distance)
                     vehicle_route_distance += arc_distance
                     vehicle_route_demand += data['demands'][r[index+1]]
@@ -428,7 +1078,7 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
 
             # returns optimised route as original Customer index (for integration with AnyLogic
             # route_index = get_route_as_object_index(current_route_customers, customers_original_order, depot)
-            current_route_customers = route_index_to_id(r, Customers[:])
+            current_route_customers = route_index_to_id(r, Customers)
 
             temp_route = {'route_number': route_number, 'customer_indices': current_route_customers,
                           'route_distance': vehicle_route_distance}
@@ -436,6 +1086,10 @@ def run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData):
             temp_route_for_plot = {'route_number': route_number, 'customer_indices': r,
                                    'route_distance': vehicle_route_distance}
 
+            if improve_routes:
+                temp_route['initial_route_distance'] = initial_route_distance
+                temp_route_for_plot['initial_route_distance'] = initial_route_distance
+
             list_of_route_dicts_1.append(temp_route)
             list_of_route_dicts_for_plot.append(temp_route_for_plot)
 
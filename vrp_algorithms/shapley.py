@@ -0,0 +1,167 @@
+import numpy as np
+
+from utilities.pool_utils import get_process_pool, share_array, attach_array
+from vrp_algorithms.savings import create_customer_list
+
+# Number of permutations evaluated together by insertion_marginal_costs (in one worker process)
+SHAPLEY_BATCH_SIZE = 32
+# sampled_shapley_values samples at least SHAPLEY_MIN_PERMUTATIONS permutations before testing the confidence
+# intervals, and stops after SHAPLEY_MAX_PERMUTATIONS permutations whether they are narrow enough or not
+SHAPLEY_MIN_PERMUTATIONS = 64
+SHAPLEY_MAX_PERMUTATIONS = 10000
+# Largest half-width of the confidence intervals of the Shapley values at which the sampling stops (in distance
+# units), and the normal quantile of the confidence level (95%)
+SHAPLEY_TOLERANCE = 1.0
+SHAPLEY_CONFIDENCE_Z = 1.96
+
+
+def create_euclidean_distance_matrix(Customers):
+    """Unrounded Euclidean distances between the Customers (the depot first)"""
+    xy = np.array([(c.pos.x, c.pos.y) for c in Customers], dtype=float)
+    return np.hypot(*(xy[:, None, :] - xy[None, :, :]).transpose(2, 0, 1))
+
+
+def insertion_marginal_costs(D, demand_list, vehicle_capacity, permutations):
+    """Marginal costs of the customers in a batch of permutations. The customers of every permutation (a row of
+    customer nodes 1..n, node 0 is the depot) join the routes one after the other, each by the cheapest feasible
+    insertion into the arcs of the routes so far, or in a route of its own if that is cheaper; its marginal cost is
+    the increase in the total distance.
+
+    The routes of all the permutations are kept as arrays of arcs (from, to, route), so every step inserts the next
+    customer of every permutation at once. Returns a (permutations, n) array, column c - 1 for customer node c."""
+    D = np.asarray(D, dtype=float)
+    demands = np.asarray(demand_list, dtype=float)
+    permutations = np.asarray(permutations, dtype=np.int64)
+    P, n = permutations.shape
+    rows = np.arange(P)
+
+    # a route of k customers has k + 1 arcs, so there are at most 2n arcs and n routes
+    arc_from = np.zeros((P, 2 * n), dtype=np.int64)
+    arc_to = np.zeros((P, 2 * n), dtype=np.int64)
+    arc_route = np.zeros((P, 2 * n), dtype=np.int64)
+    arc_count = np.zeros(P, dtype=np.int64)
+    loads = np.zeros((P, n))
+    route_count = np.zeros(P, dtype=np.int64)
+    marginal_costs = np.empty((P, n))
+
+    for t in range(n):
+        c = permutations[:, t]
+        m = int(arc_count.max())
+        if m:
+            a, b, r = arc_from[:, :m], arc_to[:, :m], arc_route[:, :m]
+            delta = D[a, c[:, None]] + D[c[:, None], b] - D[a, b]
+            feasible = (np.arange(m) < arc_count[:, None]) & \
+                       (loads[rows[:, None], r] + demands[c][:, None] <= vehicle_capacity)
+            delta = np.where(feasible, delta, np.inf)
+            best = np.argmin(delta, axis=1)
+            best_cost = delta[rows, best]
+        else:
+            best = np.zeros(P, dtype=np.int64)
+            best_cost = np.full(P, np.inf)
+        new_route_cost = D[0, c] + D[c, 0]
+        new_route = new_route_cost <= best_cost
+        marginal_costs[rows, c - 1] = np.where(new_route, new_route_cost, best_cost)
+
+        # insert into the best arc (a, b): it becomes (a, c) and the new arc (c, b) is appended
+        p, k, arc, customer = rows[~new_route], arc_count[~new_route], best[~new_route], c[~new_route]
+        arc_from[p, k] = customer
+        arc_to[p, k] = arc_to[p, arc]
+        arc_route[p, k] = arc_route[p, arc]
+        arc_to[p, arc] = customer
+        loads[p, arc_route[p, arc]] += demands[customer]
+
+        # open the route (0, c, 0)
+        p, k, r, customer = rows[new_route], arc_count[new_route], route_count[new_route], c[new_route]
+        arc_from[p, k], arc_to[p, k] = 0, customer
+        arc_from[p, k + 1], arc_to[p, k + 1] = customer, 0
+        arc_route[p, k] = arc_route[p, k + 1] = r
+        loads[p, r] = demands[customer]
+
+        arc_count += np.where(new_route, 2, 1)
+        route_count += new_route
+    return marginal_costs
+
+
+def _shapley_batch(D, demand_list, vehicle_capacity, batch_size, seed):
+    """Sums and sums of squares of the marginal costs of every customer over batch_size random permutations"""
+    rng = np.random.default_rng(seed)
+    n = len(D) - 1
+    permutations = rng.permuted(np.tile(np.arange(1, n + 1), (batch_size, 1)), axis=1)
+    marginal_costs = insertion_marginal_costs(D, demand_list, vehicle_capacity, permutations)
+    return marginal_costs.sum(axis=0), (marginal_costs ** 2).sum(axis=0)
+
+
+def _shapley_batch_worker(distance_descriptor, demand_list, vehicle_capacity, batch_size, seed):
+    """_shapley_batch on the shared distance matrix (run in a worker process)"""
+    distance_shm, D = attach_array(distance_descriptor)
+    try:
+        return _shapley_batch(D, demand_list, vehicle_capacity, batch_size, seed)
+    finally:
+        del D
+        distance_shm.close()
+
+
+def sampled_shapley_values(D, demand_list, vehicle_capacity, tolerance=SHAPLEY_TOLERANCE,
+                           batch_size=SHAPLEY_BATCH_SIZE, min_permutations=SHAPLEY_MIN_PERMUTATIONS,
+                           max_permutations=SHAPLEY_MAX_PERMUTATIONS, workers=None, seed=None):
+    """Monte Carlo estimate of the Shapley values of the customers (nodes 1..n, 0 is the depot) in the cost game of
+    the insertion routes: the mean marginal cost of every customer over random permutations (see
+    insertion_marginal_costs). The Shapley values sum to the expected total distance of the routes.
+
+    The permutations are sampled in batches of batch_size, a round of one batch per worker process at a time (in a
+    persistent pool of `workers` processes reading the distance matrix from shared memory, or in this process if
+    workers is None). The sampling stops once the SHAPLEY_CONFIDENCE_Z confidence intervals of all the customers are
+    at most tolerance wide on either side (after min_permutations), or after max_permutations. The batches are seeded
+    in turn from seed, so the same permutations are sampled whatever the number of workers (only the number of
+    batches sampled before the test can differ).
+
+    Returns the estimated Shapley values, the half-widths of their confidence intervals and the number of permutations
+    sampled (the values of customer node c at index c - 1)."""
+    D = np.asarray(D, dtype=float)
+    n = len(D) - 1
+    if n == 0:
+        return np.zeros(0), np.zeros(0), 0
+    seeds = np.random.SeedSequence(seed)
+    round_size = workers or 1
+
+    shm = None
+    if workers is not None:
+        shm, distance_descriptor = share_array(D)
+        pool = get_process_pool(workers)
+    try:
+        sums, squares = np.zeros(n), np.zeros(n)
+        permutations = 0
+        while True:
+            batch_seeds = seeds.spawn(round_size)
+            if workers is None:
+                batches = [_shapley_batch(D, demand_list, vehicle_capacity, batch_size, batch_seeds[0])]
+            else:
+                futures = [pool.submit(_shapley_batch_worker, distance_descriptor, demand_list, vehicle_capacity,
+                                       batch_size, batch_seed) for batch_seed in batch_seeds]
+                batches = [future.result() for future in futures]
+            for batch_sums, batch_squares in batches:
+                sums += batch_sums
+                squares += batch_squares
+            permutations += round_size * batch_size
+
+            values = sums / permutations
+            variances = np.maximum(squares / permutations - values ** 2, 0.0) * permutations / max(permutations - 1, 1)
+            half_widths = SHAPLEY_CONFIDENCE_Z * np.sqrt(variances / permutations)
+            if permutations >= max_permutations or \
+                    (permutations >= min_permutations and half_widths.max() <= tolerance):
+                return values, half_widths, permutations
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def shapley_distances(customerData, vehicleCapacityData, depotData, tolerance=SHAPLEY_TOLERANCE, workers=None,
+                      seed=None):
+    """sampled_shapley_values on the AnyLogic data, with the unrounded Euclidean distances including the return to
+    the depot. Returns the Shapley values and their half-widths (in customerData order), and the number of
+    permutations sampled."""
+    Customers = create_customer_list(customerData, depotData)
+    D = create_euclidean_distance_matrix(Customers)
+    demands = [round(i.demand) for i in Customers]
+    return sampled_shapley_values(D, demands, round(vehicleCapacityData), tolerance, workers=workers, seed=seed)
@@ -0,0 +1,214 @@
+import json
+import os
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import numpy as np
+
+from utilities.pool_utils import get_process_pool, discard_process_pool
+from vrp_algorithms.Sweep import run_vehicle_routing_sweep
+from vrp_algorithms.savings import run_vehicle_routing_savings, MULTI_START_TIME_LIMIT
+from vrp_algorithms.lns import run_vehicle_routing_lns, LNS_TIME_LIMIT
+
+# Names of the registered solvers
+SWEEP = "sweep"
+SAVINGS = "savings"
+MULTI_START_SAVINGS = "multi_start_savings"
+IMPROVED_SWEEP = "improved_sweep"
+IMPROVED_SAVINGS = "improved_savings"
+LNS = "lns"
+
+# Solvers run by run_portfolio by default, and its default deadline in seconds
+PORTFOLIO_SOLVERS = (SWEEP, SAVINGS, IMPROVED_SWEEP, IMPROVED_SAVINGS, LNS)
+PORTFOLIO_TIME_LIMIT = 5.0
+# Fraction of the portfolio deadline given to the solvers as their own time limit, the rest is left for starting them
+# in the worker processes and sending back the results
+PORTFOLIO_SOLVER_TIME_FRACTION = 0.8
+# Seconds run_portfolio waits past its deadline for a first solver to finish, before it runs PORTFOLIO_FALLBACK_SOLVER
+# itself instead
+PORTFOLIO_GRACE_PERIOD = 1.0
+PORTFOLIO_FALLBACK_SOLVER = SAVINGS
+
+# Registered solvers by name. A solver is called as solver(customerData, vehicleCapacityData, depotData, time_limit,
+# workers) and returns the JSON list of route dicts of the run_vehicle_routing_* functions. time_limit (in seconds, or
+# None for the solver's default) bounds the solvers that can trade time for quality, the others ignore it. workers is
+# the number of processes of the solvers that use a process pool (None for one per CPU, 1 to run serially).
+solvers = {}
+# How the route distances of each registered solver are measured: (round_distances, return_to_depot), i.e. whether
+# the arc lengths are rounded to whole units and whether the return to the depot is counted
+route_distance_measures = {}
+
+
+def register_solver(name, solver, round_distances=False, return_to_depot=True):
+    """Registers solver under name (replacing any solver registered under that name before), with the way it measures
+    its route distances"""
+    solvers[name] = solver
+    route_distance_measures[name] = (round_distances, return_to_depot)
+
+
+def get_solver(name):
+    if name not in solvers:
+        raise ValueError("Unknown solver %r, the registered solvers are %s" % (name, ", ".join(sorted(solvers))))
+    return solvers[name]
+
+
+def solve_sweep(customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    return run_vehicle_routing_sweep(customerData, vehicleCapacityData, depotData, tsp_workers=workers,
+                                     latency_budget_ms=None if time_limit is None else 1000 * time_limit)
+
+
+def solve_savings(customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    return run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData)
+
+
+def solve_multi_start_savings(customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    return run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData,
+                                       multi_start_time_limit=MULTI_START_TIME_LIMIT if time_limit is None else time_limit,
+                                       multi_start_workers=workers)
+
+
+def solve_improved_sweep(customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    return run_vehicle_routing_sweep(customerData, vehicleCapacityData, depotData, tsp_workers=workers,
+                                     latency_budget_ms=None if time_limit is None else 1000 * time_limit,
+                                     inter_route=True)
+
+
+def solve_improved_savings(customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    return run_vehicle_routing_savings(customerData, vehicleCapacityData, depotData, improve_routes=True,
+                                       inter_route=True, time_limit=time_limit)
+
+
+def solve_lns(customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    return run_vehicle_routing_lns(customerData, vehicleCapacityData, depotData,
+                                   time_limit=LNS_TIME_LIMIT if time_limit is None else time_limit)
+
+
+register_solver(SWEEP, solve_sweep)
+register_solver(SAVINGS, solve_savings, round_distances=True, return_to_depot=False)
+register_solver(MULTI_START_SAVINGS, solve_multi_start_savings, round_distances=True, return_to_depot=False)
+register_solver(IMPROVED_SWEEP, solve_improved_sweep)
+register_solver(IMPROVED_SAVINGS, solve_improved_savings, round_distances=True, return_to_depot=False)
+register_solver(LNS, solve_lns, round_distances=True, return_to_depot=False)
+
+
+def solve(name, customerData, vehicleCapacityData, depotData, time_limit=None, workers=None):
+    """Runs the solver registered under name"""
+    return get_solver(name)(customerData, vehicleCapacityData, depotData, time_limit, workers)
+
+
+def route_dicts_distance(route_dicts, customerData, depotData):
+    """Sets the route_distance of every route dict (as returned by the solvers) to the Euclidean length of the route,
+    including the return to the depot. The solvers do not all measure their routes the same way (the savings based
+    ones leave out the return to the depot), this makes their results comparable. Returns the total distance."""
+    xy = {-1: (depotData["x"], depotData["y"])}
+    xy.update((int(c["id"]) - 1, (c["x"], c["y"])) for c in customerData)
+    total_distance = 0.0
+    for route in route_dicts:
+        indices = [index for index in route["customer_indices"] if index != -1]
+        if not indices:
+            continue
+        coordinates = np.array([xy[-1]] + [xy[index] for index in indices] + [xy[-1]], dtype=float)
+        route["route_distance"] = float(np.hypot(*np.diff(coordinates, axis=0).T).sum())
+        total_distance += route["route_distance"]
+    return total_distance
+
+
+class PortfolioStatistics:
+    """Per solver record of the run_portfolio calls: how often each solver was run, finished before the deadline, won
+    and failed, and the total time its finished runs took"""
+
+    def __init__(self):
+        self.solvers = {}
+
+    def record(self, name, elapsed=None, won=False, failed=False):
+        """Records one portfolio run of solver name. elapsed is None if it did not finish before the deadline."""
+        statistics = self.solvers.setdefault(name, {"runs": 0, "completed": 0, "wins": 0, "failures": 0,
+                                                    "total_time": 0.0})
+        statistics["runs"] += 1
+        statistics["wins"] += won
+        statistics["failures"] += failed
+        if elapsed is not None:
+            statistics["completed"] += 1
+            statistics["total_time"] += elapsed
+
+    def summary(self):
+        """Returns a dict with the statistics of every solver, including its win rate and mean run time"""
+        return {name: dict(statistics, win_rate=statistics["wins"] / statistics["runs"],
+                           mean_time=statistics["total_time"] / statistics["completed"]
+                           if statistics["completed"] else None)
+                for name, statistics in self.solvers.items()}
+
+    def reset(self):
+        self.solvers.clear()
+
+
+portfolio_statistics = PortfolioStatistics()
+
+
+def _timed_solve(name, customerData, vehicleCapacityData, depotData, time_limit):
+    tic = time.perf_counter()
+    # the worker processes run the solvers serially, the portfolio already uses all of them
+    result = solve(name, customerData, vehicleCapacityData, depotData, time_limit, workers=1)
+    return result, time.perf_counter() - tic
+
+
+def run_portfolio(customerData, vehicleCapacityData, depotData, solver_names=PORTFOLIO_SOLVERS,
+                  time_limit=PORTFOLIO_TIME_LIMIT, workers=None, statistics=portfolio_statistics):
+    """Runs the solvers concurrently in a persistent pool of `workers` processes (see utilities.pool_utils) and returns
+    the shortest solution (see route_dicts_distance) among those that finished within time_limit seconds. If none
+    finished in time, the first one to finish within PORTFOLIO_GRACE_PERIOD seconds more is returned, or else the
+    solution of PORTFOLIO_FALLBACK_SOLVER run serially in this process. With fewer workers than solvers, the solvers
+    run in waves, and each is given PORTFOLIO_SOLVER_TIME_FRACTION of the time limit divided by the number of waves.
+    Not all the solvers keep to their time limit (the savings based ones run to the end), and a solver already running
+    cannot be cancelled: if any is still running at the deadline, the pool is discarded with it (see
+    discard_process_pool), so that the next calls do not queue behind it. The runs, wins and timings of every solver
+    are recorded in statistics.
+
+    The route dicts are returned in the JSON format of the run_vehicle_routing_* functions, with the route distances
+    measured as by route_dicts_distance."""
+    deadline = time.perf_counter() + time_limit
+    pool = get_process_pool(workers)
+    waves = -(-len(solver_names) // (workers or os.cpu_count() or 1))
+    futures = [pool.submit(_timed_solve, name, customerData, vehicleCapacityData, depotData,
+                           PORTFOLIO_SOLVER_TIME_FRACTION * time_limit / waves)
+               for name in solver_names]
+    done, _ = wait(futures, timeout=max(0.0, deadline - time.perf_counter()))
+    if not done:
+        done, _ = wait(futures, timeout=PORTFOLIO_GRACE_PERIOD, return_when=FIRST_COMPLETED)
+
+    results = []
+    first_error = None
+    abandoned = False
+    for name, future in zip(solver_names, futures):
+        if future not in done:
+            abandoned |= not future.cancel() and not future.done()
+            results.append((name, None, None, None, False))
+            continue
+        try:
+            result, elapsed = future.result()
+        except Exception as error:
+            first_error = first_error or error
+            results.append((name, None, None, None, True))
+            continue
+        route_dicts = json.loads(result)
+        results.append((name, route_dicts, route_dicts_distance(route_dicts, customerData, depotData), elapsed,
+                        False))
+    if abandoned:
+        discard_process_pool(pool)
+
+    finished = [(distance, k) for k, (_, route_dicts, distance, _, _) in enumerate(results) if route_dicts is not None]
+    if not finished:
+        if len(done) == len(futures):
+            raise first_error
+        for name, _, _, _, failed in results:
+            statistics.record(name, failed=failed)
+        route_dicts = json.loads(solve(PORTFOLIO_FALLBACK_SOLVER, customerData, vehicleCapacityData, depotData,
+                                       workers=1))
+        route_dicts_distance(route_dicts, customerData, depotData)
+        return json.dumps(route_dicts)
+    # ties go to the solver listed first
+    winner = min(finished)[1]
+    for k, (name, _, _, elapsed, failed) in enumerate(results):
+        statistics.record(name, elapsed, won=k == winner, failed=failed)
+
+    return json.dumps(results[winner][1])